@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the cauldron conversion and upload paths.
+
+Times py2ctypes, numpy2ctypes, _VertexBufferObject.setData,
+TextureObject.setData and VertexArrayObject.drawArrays for data sizes
+from 10 up to 1e7 elements. By default GL is replaced by a backend whose
+calls do nothing, so this runs without a GPU and measures only the Python
+side; with --backend gl it makes a hidden window (a Mesa software context
+will do) and uses real GL.
+
+Results are written as one JSON object per line, e.g.
+    python benchmark.py --output bench_output.txt
+"""
+
+import argparse
+import json
+import sys
+import time
+import pyglet
+pyglet.options['shadow_window'] = False
+import numpy as np
+import cauldron
+
+
+class NullGL:
+    # stands in for pyglet.gl: constants & types come from pyglet.gl, and
+    # the gl functions do nothing.
+    def __init__(self, gl):
+        self._gl = gl
+
+    def __getattr__(self, name):
+        value = getattr(self._gl, name)
+        if name.startswith('gl') and callable(value):
+            value = lambda *args: 0
+        setattr(self, name, value)
+        return value
+
+
+def timeit(fn, mintime=0.2, maxrepeats=1000):
+    # the best time for one call of fn, over repeats lasting about mintime
+    best = float('inf')
+    total = 0.0
+    repeats = 0
+    while total<mintime and repeats<maxrepeats:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter()-start
+        best = min(best, elapsed)
+        total += elapsed
+        repeats += 1
+    return best, repeats
+
+
+def benchmarks(size):
+    # yields (name, fn) for data of `size` floats
+    vertices = np.random.rand(max(size//3, 1), 3)
+    vertices32 = vertices.astype(cauldron.glfloat_dtype)
+    tuples = tuple(map(tuple, vertices.tolist()))
+    side = max(int(np.sqrt(size/3)), 1)
+    image = np.random.rand(side, side, 3)
+    image8 = (image*255).astype(np.uint8)
+    vao = cauldron.VertexArrayObject()
+    vbo = vao.createBuffer(data=vertices32)
+    tex = cauldron.TextureObject(image)
+    tex8 = cauldron.TextureObject(image8)
+    yield 'py2ctypes', lambda: cauldron.py2ctypes(tuples)
+    yield 'numpy2ctypes/float64', lambda: cauldron.numpy2ctypes(vertices)
+    yield 'numpy2ctypes/float32', lambda: cauldron.numpy2ctypes(vertices32)
+    yield 'VertexBufferObject.setData/tuples', lambda: vbo.setData(tuples)
+    yield 'VertexBufferObject.setData/float64', lambda: vbo.setData(vertices)
+    yield 'VertexBufferObject.setData/float32', lambda: vbo.setData(vertices32)
+    yield 'TextureObject.setData', lambda: tex.setData(image)
+    yield 'TextureObject.setData/uint8', lambda: tex8.setData(image8)
+    yield 'VertexArrayObject.drawArrays', lambda: vao.drawArrays()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--backend', choices=('null', 'gl'), default='null',
+                        help='null: GL calls do nothing; gl: real GL in a hidden window')
+    parser.add_argument('--max-size', type=float, default=1e7,
+                        help='largest data size, in elements')
+    parser.add_argument('--output', default=None, help='file for the results (default stdout)')
+    args = parser.parse_args(argv)
+
+    if args.backend=='null':
+        cauldron.gl = NullGL(cauldron.gl)
+        renderer = 'null'
+    else:
+        window = pyglet.window.Window(visible=False)
+        renderer = cauldron._glstring(cauldron.gl.GL_RENDERER).decode()
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    size = 10
+    while size<=args.max_size:
+        for name, fn in benchmarks(size):
+            seconds, repeats = timeit(fn)
+            result = dict(name=name, size=size, seconds=seconds, repeats=repeats,
+                          elements_per_second=size/seconds if seconds else None,
+                          backend=args.backend, renderer=renderer)
+            print(json.dumps(result), file=output, flush=True)
+        size *= 10
+    if args.output:
+        output.close()
+    if args.backend=='gl':
+        window.close()
+
+
+if __name__=='__main__':
+    main()
@@ -8,9 +8,105 @@ a library to help with Open GL incantations with vertex objects and buffers.
 """
 
 import pyglet.gl as gl
+import pyshaders
+import collections
+import concurrent.futures
 import ctypes
+import functools
+import hashlib
+from multiprocessing import shared_memory
+import os
+import tempfile
+import threading
+import time
 import numpy as np
-import numpy.ctypeslib as ctlib
+
+
+# GL state tracking. All the binds cauldron makes go through a GLState, 
+# which remembers what is bound and skips binds that wouldn't change 
+# anything. Buffers & textures also stay bound when a `with` block ends, 
+# rather than binding 0. Set cache_state to False to go back to binding on
+# every enter & unbinding on every exit, which is handy when debugging.
+# Vertex array objects are the exception: the vao bound before is always
+# put back when a `with` block (or a draw) ends, because raw element buffer
+# binds & attribute pointers (e.g. from pyglet.graphics) would otherwise 
+# quietly change whichever cauldron vao was left bound.
+# If you bind things with raw gl calls, call glstate().invalidate() after.
+# The program isn't cached, because pyshaders programs' use() calls 
+# glUseProgram itself, and that is how the demos use them.
+
+cache_state = True
+
+class GLState:
+    # the bindings in one GL context
+    def __init__(self):
+        self.invalidate()
+        
+    def invalidate(self):
+        # forget everything, so the next binds all happen
+        self.vao = None
+        self.buffers = {} # target -> buffer
+        self.texunit = None
+        self.textures = {} # (texunit, target) -> texture
+        
+    def bindVertexArray(self, vao):
+        if not cache_state or vao!=self.vao:
+            gl.glBindVertexArray(vao)
+            self.vao = vao
+            # the element buffer binding belongs to the vao
+            self.buffers.pop(gl.GL_ELEMENT_ARRAY_BUFFER, None)
+            
+    def bindBuffer(self, target, buffer):
+        if not cache_state or buffer!=self.buffers.get(target):
+            gl.glBindBuffer(target, buffer)
+            self.buffers[target] = buffer
+            
+    def activeTexture(self, texunit):
+        if not cache_state or texunit!=self.texunit:
+            gl.glActiveTexture(texunit)
+            self.texunit = texunit
+            
+    def bindTexture(self, target, texture):
+        key = (self.texunit, target)
+        if not cache_state or self.texunit is None or texture!=self.textures.get(key):
+            gl.glBindTexture(target, texture)
+            self.textures[key] = texture
+            
+    def useProgram(self, program):
+        # program is a GL program id, or a pyshaders program. Always binds
+        # (see above).
+        program = getattr(program, 'pid', program)
+        program = getattr(program, 'value', program)
+        gl.glUseProgram(program)
+        
+    def currentProgram(self):
+        # the id of the program in use, asked of GL, so drawables with their
+        # own program can put the caller's back afterwards
+        program = gl.GLint(0)
+        gl.glGetIntegerv(gl.GL_CURRENT_PROGRAM, ctypes.byref(program))
+        return program.value
+            
+    def deleteBuffer(self, buffer):
+        # deleting a bound buffer unbinds it
+        for target, bound in list(self.buffers.items()):
+            if bound==buffer:
+                self.buffers[target] = 0
+                
+    def deleteTexture(self, texture):
+        # deleting a bound texture unbinds it
+        for key, bound in list(self.textures.items()):
+            if bound==texture:
+                self.textures[key] = 0
+            
+_glstates = {}
+
+def glstate():
+    # the GLState for the current context
+    context = gl.current_context
+    state = _glstates.get(context)
+    if state is None:
+        state = _glstates[context] = GLState()
+    return state
 
 
 class VertexArrayObject:
@@ -20,15 +116,19 @@ class VertexArrayObject:
         gl.glGenVertexArrays(1, ctypes.byref(_vao))
         self._vao = _vao
         self.buffers = []
+        self.elements = None
+        self._previous = [] # the vaos bound before, for nested with blocks
         
     def __enter__(self):
         # binds the vertex array object 
-        gl.glBindVertexArray(self._vao)
+        state = glstate()
+        self._previous.append(state.vao)
+        state.bindVertexArray(self._vao.value)
         return self
     
     def __exit__(self, extype, exvalue, extraceback):
-        # releases the vertex array object
-        gl.glBindVertexArray(0)
+        # puts back the vertex array object bound before (0 if not known)
+        glstate().bindVertexArray(self._previous.pop() or 0)
         
     def createBuffer(self, **kwargs):
         # creates a buffer object connected to self
@@ -37,152 +137,2125 @@ class VertexArrayObject:
         self.buffers.append(buffer)
         return buffer
     
-    def drawArrays(self, mode=gl.GL_TRIANGLE_STRIP, first=0, count=None):
+    def createElementBuffer(self, **kwargs):
+        # creates the element (index) buffer used by drawElements. 
+        # There is only one per vertex array object.
+        with self:
+            self.elements = _ElementBufferObject(self, **kwargs)
+        return self.elements
+    
+    def createInterleavedBuffer(self, **kwargs):
+        # creates an interleaved buffer object connected to self
+        with self:
+            buffer = _InterleavedBufferObject(self, **kwargs)
+        self.buffers.append(buffer)
+        return buffer
+    
+    def createStreamingBuffer(self, **kwargs):
+        # creates a streaming buffer object connected to self
+        with self:
+            buffer = _StreamingBufferObject(self, **kwargs)
+        self.buffers.append(buffer)
+        return buffer
+    
+    def drawArrays(self, mode=gl.GL_TRIANGLE_STRIP, first=None, count=None):
+        if first is None:
+            first = self.buffers[0].first
         if count is None:
             count = self.buffers[0].n
         with self:
             gl.glDrawArrays(mode, first, count)
             
+    def drawElements(self, mode=gl.GL_TRIANGLES, first=0, count=None):
+        # draws using the indices in the element buffer, from index first
+        if count is None:
+            count = self.elements.n-first
+        offset = first*self.elements.size.itemsize
+        with self:
+            gl.glDrawElements(mode, count, self.elements.indextype, ctypes.c_void_p(offset))
+            
+    def _instances(self):
+        # the number of instances the instanced buffers have data for
+        counts = [b.n*b.divisor for b in self.buffers if b.divisor]
+        if not counts:
+            raise ValueError('instances must be given when no buffer is instanced (has a divisor)')
+        return min(counts)
+            
+    def drawArraysInstanced(self, instances=None, mode=gl.GL_TRIANGLE_STRIP, first=None, count=None):
+        # draws the vertices instances times. Per-instance data (offsets,
+        # colours...) comes from buffers connected with a divisor.
+        # buffers[0] should be a per-vertex buffer.
+        if instances is None:
+            instances = self._instances()
+        if first is None:
+            first = self.buffers[0].first
+        if count is None:
+            count = self.buffers[0].n
+        with self:
+            gl.glDrawArraysInstanced(mode, first, count, instances)
+            
+    def drawElementsInstanced(self, instances=None, mode=gl.GL_TRIANGLES, first=0, count=None):
+        # drawElements, instances times
+        if instances is None:
+            instances = self._instances()
+        if count is None:
+            count = self.elements.n-first
+        offset = first*self.elements.size.itemsize
+        with self:
+            gl.glDrawElementsInstanced(mode, count, self.elements.indextype, 
+                                       ctypes.c_void_p(offset), instances)
+            
 
 class _VertexBufferObject:
     # Vertex Buffer Object as an object
-    def __init__(self, vao, target=gl.GL_ARRAY_BUFFER, usage=gl.GL_DYNAMIC_DRAW, data=None):
+    def __init__(self, vao, target=gl.GL_ARRAY_BUFFER, usage=gl.GL_DYNAMIC_DRAW, data=None,
+                 orphan=False):
         self._vao = vao
         _vbo = gl.GLuint(0)
         gl.glGenBuffers(1, ctypes.byref(_vbo))
         self._vbo = _vbo
         self.target = target
         self.usage = usage
+        # if orphan is true, whole-buffer updates detach the old storage
+        # first, so the driver doesn't wait for draws still reading it.
+        self.orphan = orphan
+        self.capacity = 0 # allocated bytes
+        self.first = 0
+        self.n = 0
+        self.divisor = 0
+        self.gltype = gl.GL_FLOAT
         if data is not None:
             self.setData(data)
             
     def __enter__(self):
-        # binds the vertex array object 
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self._vbo)
+        # binds the buffer object. An element buffer binding is part of the
+        # vao state, so the vao has to be bound first.
+        if self.target==gl.GL_ELEMENT_ARRAY_BUFFER:
+            self._vao.__enter__()
+        glstate().bindBuffer(self.target, self._vbo.value)
         return self
     
     def __exit__(self, extype, exvalue, extraceback):
-        # releases the vertex array object
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        # releases the buffer object; element buffers stay bound to the vao,
+        # which is released
+        if self.target==gl.GL_ELEMENT_ARRAY_BUFFER:
+            self._vao.__exit__(extype, exvalue, extraceback)
+        elif not cache_state:
+            glstate().bindBuffer(self.target, 0)
         
-    def setData(self, data, target=None, usage=None):
-        # puts the data in the buffer
-        if type(data) in (list, tuple):
-            data, self.size = py2ctypes(data)
-        elif type(data) is np.ndarray:
-            data, self.size = numpy2ctypes(data)
-        self.n = len(data) # used when drawing
+    def setData(self, data, target=None, usage=None, offset=None):
+        # puts the data in the buffer. If offset (in vertices) is given, only
+        # the vertices from offset on are replaced, otherwise the data
+        # replaces the whole buffer. The buffer storage is only reallocated
+        # when the data doesn't fit in it.
+        # uint8, uint16 and float16 numpy arrays are stored as they are (see
+        # numpy2ctypes); connect with normalized=True to have integers read
+        # as 0-1 in the shader.
+        data, size = self._convert(data)
+        nbytes = ctypes.sizeof(data)
         target = target or self.target
         usage = usage or self.usage
+        if offset is None:
+            self.size = size
+            self.n = len(data) # used when drawing
+            self.gltype = gltype(data)
+            start = 0
+        else:
+            if size!=self.size:
+                raise ValueError(f'vertex size {size} does not match buffer vertex size {self.size}')
+            if gltype(data)!=self.gltype:
+                raise ValueError('data type does not match the buffer data type')
+            start = offset*ctypes.sizeof(data._type_)
+            if start+nbytes>self.capacity:
+                raise ValueError('data does not fit in the buffer')
+            self.n = max(self.n, offset+len(data))
         with self:
-            gl.glBufferData(target, ctypes.sizeof(data), data, usage)
+            if nbytes>self.capacity or (offset is None and usage!=self.usage):
+                # (re)allocate the storage
+                gl.glBufferData(target, nbytes, data, usage)
+                self.capacity = nbytes
+                self.usage = usage
+            else:
+                if self.orphan and offset is None:
+                    gl.glBufferData(target, self.capacity, None, usage)
+                gl.glBufferSubData(target, start, nbytes, data)
+                
+    def _convert(self, data):
+        # converts the data to ctypes, and works out the vertex size
+        if type(data) in (list, tuple):
+            return py2ctypes(data)
+        elif type(data) is np.ndarray:
+            return numpy2ctypes(data)
+        return data, self.size
             
-    def connectToShader(self, location, normalized=False):
+    def connectToShader(self, location, normalized=False, divisor=0):
         # enables a location in the shader & binds this buffer to it.
         # note that both the vao and self have to be in use for this to work.
         # If the location value isn't known, use <shader>.attributes.name.loc to get it
+        # If divisor isn't 0, this is an instanced attribute, which moves on
+        # to the next value every divisor instances rather than every vertex.
+        self.divisor = divisor
         with self._vao:
             with self:
                 gl.glEnableVertexAttribArray(location)
-                gl.glVertexAttribPointer(location, self.size, gl.GL_FLOAT, normalized, 0, 0)
+                gl.glVertexAttribPointer(location, self.size, self.gltype, normalized, 0, 0)
+                gl.glVertexAttribDivisor(location, divisor)
 
 
 
-# conversion routines to change lists, np arrays to the appropriate ctypes
-# data for vertex buffers.
+class _ElementBufferObject(_VertexBufferObject):
+    # An index buffer for VertexArrayObject.drawElements. The indices are
+    # stored as uint16 if they fit, otherwise uint32, unless the data is
+    # a numpy array which is already one of those. Here size is the numpy 
+    # index dtype.
+    def __init__(self, vao, usage=gl.GL_STATIC_DRAW, data=None, orphan=False):
+        self.size = None
+        super().__init__(vao, target=gl.GL_ELEMENT_ARRAY_BUFFER, usage=usage, 
+                         data=data, orphan=orphan)
+        
+    def _convert(self, data):
+        data = np.asarray(data)
+        if data.size and data.dtype.kind not in 'iu':
+            raise ValueError(f'indices must be integers, not {data.dtype}')
+        if data.size and data.min()<0:
+            raise ValueError('indices can\'t be negative')
+        dtype = data.dtype
+        if dtype not in index_ctypes:
+            # keep the current index type for updates, if the data fits
+            dtype = self.size
+            if dtype is None or (data.size and data.max()>np.iinfo(dtype).max):
+                dtype = np.dtype(np.uint32 if data.size and data.max()>0xffff else np.uint16)
+        data = np.ascontiguousarray(data, dtype=dtype).ravel()
+        cdata = (index_ctypes[dtype]*len(data)).from_address(data.ctypes.data)
+        cdata._keep = data
+        return cdata, dtype
+    
+    @property
+    def indextype(self):
+        # the gl type of the indices
+        return index_gltypes[self.size]
+    
 
-def find_ctype(data):
-    # works out the nested ctype for the data, which
-    # may be lists of lists
-    if type(data) in (list, tuple):
-        return find_ctype(data[0])*len(data)
-    else:
-        return gl.GLfloat
+class _InterleavedBufferObject(_VertexBufferObject):
+    # A vertex buffer holding several attributes per vertex, e.g. position
+    # and texture coordinate, one after the other. The data is a numpy
+    # structured array, or a dict of field name -> per-vertex data, e.g.
+    #   {'position':((-0.6, -0.5, 0.1), ...), 'tex_coord':((0,0), ...)}
+    # and size is the structured dtype, which gives the stride & offsets.
+    # Fields keep their type if it is one of the gl_types, e.g. uint8 
+    # colours; normalized only affects the integer fields.
+    def _convert(self, data):
+        return structured2ctypes(data)
     
-def tuplify(data):
-    if type(data[0]) in (list, tuple):
-        return tuple(tuplify(d) for d in data)
-    else:
-        return tuple(data)
+    def connectToShader(self, normalized=False, divisor=0, **locations):
+        # connects each named field to a location in the shader, e.g.
+        # connectToShader(position=0, tex_coord=1). With a divisor, all
+        # the fields are instanced attributes.
+        self.divisor = divisor
+        stride = self.size.itemsize
+        with self._vao:
+            with self:
+                for name, location in locations.items():
+                    fieldtype, offset = self.size.fields[name][:2]
+                    components = fieldtype.shape[0] if fieldtype.shape else 1
+                    gltype = gl_types[fieldtype.base][0]
+                    gl.glEnableVertexAttribArray(location)
+                    gl.glVertexAttribPointer(location, components, gltype, normalized, 
+                                             stride, ctypes.c_void_p(offset))
+                    gl.glVertexAttribDivisor(location, divisor)
 
-def py2ctypes(data):
-    # converts a list (or list of lists) to a ctypes array of arrays,
-    # specifically for vertex data
-    elemsize = len(data[0]) if type(data[0]) in (list, tuple) else 1
-    data = (find_ctype(data))(*tuplify(data))
-    return data, elemsize
+            
+class _StreamingBufferObject(_VertexBufferObject):
+    # A vertex buffer for data that changes every frame. The buffer is split
+    # into `segments` parts of `capacity` vertices which are used in turn, 
+    # one per frame. Each frame you write the vertices straight into GPU 
+    # memory through the numpy array returned by map(), draw, and then
+    # call fence(). The fence stops map() handing out a segment the GPU is
+    # still reading from.
+    # If glBufferStorage is available, the whole buffer stays mapped
+    # (persistent mapping); otherwise each segment is mapped unsynchronized
+    # and has to be unmap()'d before drawing.
+    def __init__(self, vao, size, capacity, segments=3, target=gl.GL_ARRAY_BUFFER):
+        super().__init__(vao, target=target, usage=gl.GL_STREAM_DRAW)
+        self.size = size
+        self.segments = segments
+        self.segcapacity = capacity
+        self.capacity = segments*capacity*size*ctypes.sizeof(gl.GLfloat)
+        self.segment = 0
+        self.fences = [None]*segments
+        self.persistent = hasattr(gl, 'glBufferStorage')
+        self._mapped = None
+        with self:
+            if self.persistent:
+                flags = (gl.GL_MAP_WRITE_BIT | 
+                         getattr(gl, 'GL_MAP_PERSISTENT_BIT', 0x0040) |
+                         getattr(gl, 'GL_MAP_COHERENT_BIT', 0x0080))
+                gl.glBufferStorage(self.target, self.capacity, None, flags)
+                ptr = gl.glMapBufferRange(self.target, 0, self.capacity, flags)
+                self._mapped = self._asarray(ptr, segments*capacity)
+            else:
+                gl.glBufferData(self.target, self.capacity, None, self.usage)
+                
+    def _asarray(self, ptr, n):
+        # a writable numpy view of n vertices of mapped memory at ptr
+        cdata = glfloat_array((n, self.size)).from_address(ptr)
+        return np.frombuffer(cdata, dtype=glfloat_dtype).reshape(n, self.size)
+    
+    def map(self, n=None):
+        # returns a writable (n, size) numpy view of this frame's segment.
+        # Waits if the GPU is still using the segment.
+        n = self.segcapacity if n is None else n
+        if n>self.segcapacity:
+            raise ValueError(f'{n} vertices do not fit in a segment of {self.segcapacity}')
+        self._wait(self.segment)
+        self.first = self.segment*self.segcapacity
+        self.n = n
+        if self.persistent:
+            return self._mapped[self.first:self.first+n]
+        vbytes = self.size*ctypes.sizeof(gl.GLfloat)
+        flags = (gl.GL_MAP_WRITE_BIT | gl.GL_MAP_UNSYNCHRONIZED_BIT |
+                 gl.GL_MAP_INVALIDATE_RANGE_BIT)
+        with self:
+            ptr = gl.glMapBufferRange(self.target, self.first*vbytes, n*vbytes, flags)
+        return self._asarray(ptr, n)
+    
+    def unmap(self):
+        # finishes writing to the segment. Only does anything if the
+        # buffer isn't persistently mapped.
+        if not self.persistent:
+            with self:
+                gl.glUnmapBuffer(self.target)
+                
+    def fence(self):
+        # call after the draw calls that read the current segment; marks
+        # the segment as busy until the GPU is done with it, and moves on
+        # to the next segment.
+        self.fences[self.segment] = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.segment = (self.segment+1)%self.segments
+        
+    def _wait(self, segment):
+        # waits for the fence on a segment, if any.
+        sync = self.fences[segment]
+        if sync is None:
+            return
+        timeout = 1000000 # nanoseconds
+        while gl.glClientWaitSync(sync, gl.GL_SYNC_FLUSH_COMMANDS_BIT, timeout)==gl.GL_TIMEOUT_EXPIRED:
+            pass
+        gl.glDeleteSync(sync)
+        self.fences[segment] = None
+        
+    def setData(self, data):
+        # copies data into the next segment; a convenience for when the
+        # data isn't generated in place.
+        data = np.asarray(data)
+        self.map(len(data))[...] = data.reshape(len(data), self.size)
+        self.unmap()
+
+
+
+class DrawBatch:
+    # Draws many objects that share a vertex layout (and shader, textures,
+    # uniforms) with one glMultiDrawArrays call. Each object's vertices are
+    # packed into one interleaved buffer; the data for an object is a dict
+    # of field name -> per-vertex data, or a structured array, as for
+    # VertexArrayObject.createInterleavedBuffer. Changed objects are
+    # uploaded when the batch is next drawn, and only their vertex ranges.
+    def __init__(self, capacity=1024):
+        # capacity is the initial number of vertices; it grows as needed.
+        self.vao = VertexArrayObject()
+        self.capacity = capacity
+        self.buffer = None
+        self.records = None
+        self.used = 0
+        self.firsts = []
+        self.counts = []
+        self.locations = {}
+        self._dirty = set()
+        self._resized = False
+        self._arrays = None
+        
+    def add(self, data):
+        # adds an object to the batch, returning its index
+        records = structured2numpy(data)
+        n = len(records)
+        if self.records is None:
+            self.records = np.zeros(max(self.capacity, n), dtype=records.dtype)
+        if self.used+n>len(self.records):
+            grown = np.zeros(max(2*len(self.records), self.used+n), dtype=self.records.dtype)
+            grown[:self.used] = self.records[:self.used]
+            self.records = grown
+            self._resized = True
+        self._put(self.used, records)
+        self.firsts.append(self.used)
+        self.counts.append(n)
+        self.used += n
+        self._arrays = None
+        self._dirty.add(len(self.counts)-1)
+        return len(self.counts)-1
+    
+    def update(self, index, data):
+        # replaces the vertices of object index; there must be as many as before
+        records = structured2numpy(data)
+        first, count = self.firsts[index], self.counts[index]
+        if len(records)!=count:
+            raise ValueError(f'object {index} has {count} vertices, not {len(records)}')
+        self._put(first, records)
+        self._dirty.add(index)
+        
+    def _put(self, first, records):
+        # copies records in from vertex first, field by field by name, since
+        # assigning structured arrays matches the fields by position.
+        dtype = self.records.dtype
+        if (set(records.dtype.names)!=set(dtype.names) or 
+            any(records.dtype[name]!=dtype[name] for name in dtype.names)):
+            raise ValueError(f'object fields {records.dtype.descr} do not match the batch fields {dtype.descr}')
+        for name in dtype.names:
+            self.records[name][first:first+len(records)] = records[name]
+        
+    def connectToShader(self, normalized=False, **locations):
+        # connects the fields to shader locations, as for interleaved buffers
+        self.locations = dict(normalized=normalized, **locations)
+        if self.buffer is not None:
+            self.buffer.connectToShader(**self.locations)
+            
+    def _flush(self):
+        # uploads the changed parts of the batch
+        if self.buffer is None:
+            self.buffer = self.vao.createInterleavedBuffer(data=self.records)
+            if self.locations:
+                self.buffer.connectToShader(**self.locations)
+        elif self._resized:
+            self.buffer.setData(self.records)
+        else:
+            # join the dirty objects into runs of adjacent ones
+            start = end = None
+            for index in sorted(self._dirty):
+                first, count = self.firsts[index], self.counts[index]
+                if first!=end:
+                    if start is not None:
+                        self.buffer.setData(self.records[start:end], offset=start)
+                    start = first
+                end = first+count
+            if start is not None:
+                self.buffer.setData(self.records[start:end], offset=start)
+        self._dirty.clear()
+        self._resized = False
+        
+    def draw(self, mode=gl.GL_TRIANGLE_FAN):
+        # draws all the objects
+        if not self.counts:
+            return
+        if self._dirty or self._resized:
+            self._flush()
+        if self._arrays is None:
+            n = len(self.counts)
+            self._arrays = ((gl.GLint*n)(*self.firsts), (gl.GLsizei*n)(*self.counts))
+        firsts, counts = self._arrays
+        with self.vao:
+            gl.glMultiDrawArrays(mode, firsts, counts, len(self.counts))
+            
+    
+# conversion routines to change lists, np arrays to the appropriate ctypes
+# data for vertex buffers.
 
 # work out byte sizes and numpy format for glfloat
 bytes = ctypes.sizeof(gl.GLfloat)
 glfloat_dtype = np.dtype(f'f{bytes}')
 
+# the numpy types that go to GL as they are, as (gl type, ctypes type).
+# Arrays of any other type are converted to glfloat. Half floats have no
+# ctypes type, so they travel as GLushort.
+gl_types = {
+    glfloat_dtype:(gl.GL_FLOAT, gl.GLfloat),
+    np.dtype(np.float16):(gl.GL_HALF_FLOAT, gl.GLushort),
+    np.dtype(np.uint8):(gl.GL_UNSIGNED_BYTE, gl.GLubyte),
+    np.dtype(np.uint16):(gl.GL_UNSIGNED_SHORT, gl.GLushort),
+    }
+
+@functools.lru_cache(maxsize=None)
+def gl_array(shape, dtype=glfloat_dtype):
+    # the nested ctypes array type for an array of the given shape & one of
+    # the gl_types, cached so repeated uploads of the same shape don't 
+    # build a new type.
+    ctype = gl_types[dtype][1]
+    for dim in reversed(shape):
+        ctype = ctype*dim
+    return ctype
+
+def glfloat_array(shape):
+    return gl_array(shape, glfloat_dtype)
+
+# staging buffers for py2ctypes, one per shape, for the most recently used
+# shapes. Big uploads aren't kept, so one-offs don't hold on to memory.
+_py_buffers = collections.OrderedDict()
+py_buffers_max = 16
+py_buffers_maxsize = 1<<16 # values
+
+def py2ctypes(data):
+    # converts a list (or list of lists) to a ctypes array of arrays,
+    # specifically for vertex data. The values are copied in bulk into a
+    # glfloat buffer that is reused for every upload of the same shape, so
+    # the result is only valid until the next py2ctypes call with that shape
+    # (two results of the same shape are the same memory). Not thread-safe.
+    shape = np.shape(data)
+    buffer = _py_buffers.get(shape)
+    if buffer is None:
+        buffer = np.empty(shape, dtype=glfloat_dtype)
+        if buffer.size<=py_buffers_maxsize:
+            _py_buffers[shape] = buffer
+            if len(_py_buffers)>py_buffers_max:
+                _py_buffers.popitem(last=False)
+    else:
+        _py_buffers.move_to_end(shape)
+    buffer[...] = data
+    return numpy2ctypes(buffer)
+
 def numpy2ctypes(data):
-    # converts a numpy array of floats to a ctypes array
-    # of GLfloat.
-    # 1. work out size of glfloat & corresponding numpy format
-    # 2. check type of data and convert to glfloat_dtype as needed
-    if data.dtype!=glfloat_dtype:
-        data = data.astype(glfloat_dtype)
-    # 3. work out the elemsize
+    # wraps a numpy array as a ctypes array, which GL receives as a raw 
+    # pointer into the numpy buffer. uint8, uint16, float16 & glfloat arrays
+    # keep their type (see gl_types); anything else becomes GLfloat.
+    # 1. make the data contiguous; this is a no-op (no copy) if it already 
+    #    is, and a single copy otherwise
+    dtype = data.dtype if data.dtype in gl_types else glfloat_dtype
+    data = np.ascontiguousarray(data, dtype=dtype)
+    # 2. work out the elemsize
     elemsize = 1
     if data.ndim>1:
-        elemsize = len(data[0])
-    # 4. convert the data & return
-    data = ctlib.as_ctypes(data)
-    return data, elemsize
+        elemsize = data.shape[1]
+    # 3. point a ctypes array at the numpy memory & keep the numpy
+    #    array alive for as long as the ctypes array is.
+    cdata = gl_array(data.shape, dtype).from_address(data.ctypes.data)
+    cdata._keep = data
+    return cdata, elemsize
+
+def gltype(cdata):
+    # the gl type of a ctypes array from numpy2ctypes or py2ctypes; other
+    # ctypes data is taken to be GLfloat.
+    keep = getattr(cdata, '_keep', None)
+    if keep is None or keep.dtype not in gl_types:
+        return gl.GL_FLOAT
+    return gl_types[keep.dtype][0]
+
+# texture internal formats for the gl_types, by number of channels (1-4),
+# and the pixel formats of the data
+texture_formats = {
+    glfloat_dtype:(gl.GL_R32F, gl.GL_RG32F, gl.GL_RGB32F, gl.GL_RGBA32F),
+    np.dtype(np.float16):(gl.GL_R16F, gl.GL_RG16F, gl.GL_RGB16F, gl.GL_RGBA16F),
+    np.dtype(np.uint8):(gl.GL_R8, gl.GL_RG8, gl.GL_RGB8, gl.GL_RGBA8),
+    np.dtype(np.uint16):(gl.GL_R16, gl.GL_RG16, gl.GL_RGB16, gl.GL_RGBA16),
+    }
+pixel_formats = (gl.GL_RED, gl.GL_RG, gl.GL_RGB, gl.GL_RGBA)
+
+def texture_format(cdata, ndim=2):
+    # (internalformat, format, type) for image data from numpy2ctypes or 
+    # py2ctypes, which has ndim dimensions for one channel and one more
+    # for 2-4 channels, e.g. (height, width) or (height, width, 3).
+    data = cdata._keep
+    channels = data.shape[ndim] if data.ndim>ndim else 1
+    return (texture_formats[data.dtype][channels-1], pixel_formats[channels-1], 
+            gl_types[data.dtype][0])
+
+def unpack_alignment(rowbytes):
+    # the GL_UNPACK_ALIGNMENT for rows of rowbytes; the default of 4 is
+    # wrong for e.g. odd widths of uint8 rgb.
+    return 4 if rowbytes%4==0 else 1
+
+def structured2ctypes(data):
+    # converts a dict of per-vertex data, or a numpy structured array, to 
+    # a ctypes array of interleaved records. Returns the ctypes data
+    # and the structured dtype describing the records.
+    records = structured2numpy(data)
+    dtype = records.dtype
+    cdata = ((ctypes.c_ubyte*dtype.itemsize)*len(records)).from_address(records.ctypes.data)
+    cdata._keep = records
+    return cdata, dtype
+
+def structured2numpy(data):
+    # converts a dict of per-vertex data, or a numpy structured array, to
+    # a contiguous numpy structured array. Fields that are numpy arrays of
+    # one of the gl_types keep their type, and the rest become GLfloat.
+    # Each field starts on a 4 byte boundary, as GL wants.
+    if type(data) is dict:
+        fields = {name:np.asarray(value) for name, value in data.items()}
+    else:
+        fields = {name:data[name] for name in data.dtype.names}
+    fields = {name:value if value.dtype in gl_types else value.astype(glfloat_dtype) 
+              for name, value in fields.items()}
+    names, formats, offsets = [], [], []
+    offset = 0
+    for name, value in fields.items():
+        names.append(name)
+        formats.append((value.dtype, value.shape[1:]))
+        offsets.append(offset)
+        offset += -(-value.dtype.itemsize*int(np.prod(value.shape[1:]))//4)*4
+    dtype = np.dtype(dict(names=names, formats=formats, offsets=offsets, itemsize=offset))
+    if type(data) is np.ndarray and data.dtype==dtype:
+        records = np.ascontiguousarray(data)
+    else:
+        records = np.empty(len(next(iter(fields.values()))), dtype=dtype)
+        for name, value in fields.items():
+            records[name] = value
+    return records
+
+# index types for element buffers
+index_ctypes = {np.dtype(np.uint16):gl.GLushort, np.dtype(np.uint32):gl.GLuint}
+index_gltypes = {np.dtype(np.uint16):gl.GL_UNSIGNED_SHORT, np.dtype(np.uint32):gl.GL_UNSIGNED_INT}
 
         
 class TextureObject:
-    def __init__(self, data=None):
+    # The texture storage is immutable (glTexStorage2D): it is allocated
+    # once, the first time data is set, and after that setData and update
+    # only replace the pixels. Setting data of a different size makes a new
+    # texture.
+    # If pbos is given, uploads are staged through that many pixel unpack
+    # buffers used in turn: setData copies the pixels into one and returns,
+    # and the transfer to the texture happens while the GPU gets on with 
+    # other things.
+    # The data can have 1-4 channels of float32, float16, uint8 or uint16
+    # (see gl_types), and is uploaded as it is; uint8 & uint16 are read 
+    # as 0-1 in the shader. internalformat is the storage format; if it is
+    # None it follows the data, e.g. GL_RGB8 for uint8 rgb, otherwise GL
+    # converts the data to it.
+    def __init__(self, data=None, pbos=0, internalformat=None):
         _tex = gl.GLuint(0)
         gl.glGenTextures(1, ctypes.byref(_tex))
         self._tex = _tex
+        self.internalformat = internalformat
+        self.storage = None # the allocated internal format
+        self.width = self.height = 0
         self.texunit = -1
+        self._pbos = (gl.GLuint*pbos)()
+        if pbos:
+            gl.glGenBuffers(pbos, self._pbos)
+        self._nextpbo = 0
         if data is not None:
             self.setData(data)
         
     def __enter__(self):
         # binds the vertex array object 
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self._tex)
+        glstate().bindTexture(gl.GL_TEXTURE_2D, self._tex.value)
         return self
     
     def __exit__(self, extype, exvalue, extraceback):
         # releases the vertex array object
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        if not cache_state:
+            glstate().bindTexture(gl.GL_TEXTURE_2D, 0)
+        
+    def _allocate(self, width, height, internalformat=None):
+        # gives the texture storage & sets the filters. Storage can't be 
+        # resized, so if there is some already we need a new texture name.
+        if self.width:
+            gl.glDeleteTextures(1, ctypes.byref(self._tex))
+            glstate().deleteTexture(self._tex.value)
+            _tex = gl.GLuint(0)
+            gl.glGenTextures(1, ctypes.byref(_tex))
+            self._tex = _tex
+        self.width, self.height = width, height
+        self.storage = internalformat or self.internalformat
+        with self:
+            levels = 1
+            # Internal format GL_RGB32F should avoid clamping of inputs, so
+            # contrasts can be used.
+            gl.glTexStorage2D(gl.GL_TEXTURE_2D, levels, self.storage, width, height)
+            gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+            gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
 
     def setData(self, data):
-        # the data has to be a 2D array of rgb float, preferably float32
+        # the data is a (height, width) or (height, width, channels) array
         if type(data) in (list, tuple):
             data, self.size = py2ctypes(data)
         elif type(data) is np.ndarray:
             data, self.size = numpy2ctypes(data)
+        width = self.size
+        height = len(data)
+        internalformat = self.internalformat or texture_format(data)[0]
+        if (width, height, internalformat)!=(self.width, self.height, self.storage):
+            self._allocate(width, height, internalformat)
+        self._subImage(data, 0, 0, width, height)
+        
+    def update(self, data, x=0, y=0):
+        # replaces the width*height rectangle of pixels starting at
+        # column x, row y with data.
+        if type(data) in (list, tuple):
+            data, width = py2ctypes(data)
+        elif type(data) is np.ndarray:
+            data, width = numpy2ctypes(data)
+        height = len(data)
+        if x<0 or y<0 or x+width>self.width or y+height>self.height:
+            raise ValueError('update rectangle is outside the texture')
+        self._subImage(data, x, y, width, height)
+        
+    def _subImage(self, data, x, y, width, height):
+        _, format, type = texture_format(data)
+        alignment = unpack_alignment(ctypes.sizeof(data)//height)
         with self:
             level = 0
-            border = 0
-            width = self.size
-            height = len(data)
-            # Internal format GL_RGB32F should avoid clamping of inputs, so
-            # contrasts can be used.
-            gl.glTexImage2D(gl.GL_TEXTURE_2D, level, gl.GL_RGB32F, 
-                            width, height, border, gl.GL_RGB, gl.GL_FLOAT, data)
-            gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
-            gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+            if self._pbos:
+                data = self._stage(data)
+            if alignment!=4:
+                gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, alignment)
+            gl.glTexSubImage2D(gl.GL_TEXTURE_2D, level, x, y, width, height, 
+                               format, type, data)
+            if alignment!=4:
+                gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
+            if self._pbos:
+                glstate().bindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+                
+    def _stage(self, data):
+        # copies data into the next pixel unpack buffer and leaves it bound,
+        # so glTexSubImage2D reads from it. Returns the data offset in the 
+        # buffer, which is what glTexSubImage2D wants instead of the data.
+        pbo = self._pbos[self._nextpbo]
+        self._nextpbo = (self._nextpbo+1)%len(self._pbos)
+        target = gl.GL_PIXEL_UNPACK_BUFFER
+        nbytes = ctypes.sizeof(data)
+        glstate().bindBuffer(target, pbo)
+        # orphan the old contents so we don't wait for a previous transfer
+        gl.glBufferData(target, nbytes, None, gl.GL_STREAM_DRAW)
+        ptr = gl.glMapBufferRange(target, 0, nbytes, 
+                                  gl.GL_MAP_WRITE_BIT | gl.GL_MAP_INVALIDATE_BUFFER_BIT)
+        ctypes.memmove(ptr, data, nbytes)
+        gl.glUnmapBuffer(target)
+        return None
             
     def connectToShader(self, uniform):
         # sets up the shader connection prior to drawing.
         uloc = uniform.loc.value
         self.texunit = gl.GL_TEXTURE0+uloc
-        gl.glActiveTexture(self.texunit)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self._tex) # bind it 
+        glstate().activeTexture(self.texunit)
+        glstate().bindTexture(gl.GL_TEXTURE_2D, self._tex.value) # bind it 
         # connect the shader uniform at uloc to the texture number TEXTURE0+uloc
         gl.glUniform1i(uloc, uloc)
 
 
     def disconnect(self):
         # makes this texture no longer active (probably)
-        gl.glActiveTexture(self.texunit)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        glstate().activeTexture(self.texunit)
+        glstate().bindTexture(gl.GL_TEXTURE_2D, 0)
         
     def free(self):
         # sometimes useful if running the program repeatedly
         gl.glDeleteTextures(1,ctypes.byref(self._tex))
+        glstate().deleteTexture(self._tex.value)
+        if self._pbos:
+            gl.glDeleteBuffers(len(self._pbos), self._pbos)
+            for pbo in self._pbos:
+                glstate().deleteBuffer(pbo)
+
+
+class FrameBufferObject:
+    # Somewhere to draw offscreen, at any size. Drawing done inside
+    #   with fbo:
+    # goes to fbo.texture (a TextureObject, so it can be drawn with in turn)
+    # rather than the window. The pixels can be read back into numpy arrays,
+    # either straight away with read(), or without waiting for the GPU by
+    # calling startRead() after drawing a frame and finishRead() a frame 
+    # or so later; the reads go through `pbos` pixel pack buffers in turn.
+    # Read pixels are (height, width, 4) float32 rgba with row 0 at the bottom.
+    def __init__(self, width, height, internalformat=gl.GL_RGBA32F, depth=True, pbos=2):
+        self.width, self.height = width, height
+        _fbo = gl.GLuint(0)
+        gl.glGenFramebuffers(1, ctypes.byref(_fbo))
+        self._fbo = _fbo
+        self.texture = TextureObject(internalformat=internalformat)
+        self.texture._allocate(width, height)
+        self._depth = gl.GLuint(0)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, _fbo)
+        gl.glFramebufferTexture2D(gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, 
+                                  gl.GL_TEXTURE_2D, self.texture._tex, 0)
+        if depth:
+            gl.glGenRenderbuffers(1, ctypes.byref(self._depth))
+            gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, self._depth)
+            gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, gl.GL_DEPTH_COMPONENT24, width, height)
+            gl.glFramebufferRenderbuffer(gl.GL_FRAMEBUFFER, gl.GL_DEPTH_ATTACHMENT, 
+                                         gl.GL_RENDERBUFFER, self._depth)
+            gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, 0)
+        status = gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+        if status!=gl.GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError(f'framebuffer is incomplete (status {status:#x})')
+        self.nbytes = width*height*4*ctypes.sizeof(gl.GLfloat)
+        self._pbos = (gl.GLuint*pbos)()
+        if pbos:
+            gl.glGenBuffers(pbos, self._pbos)
+            for pbo in self._pbos:
+                glstate().bindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+                gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, self.nbytes, None, gl.GL_STREAM_READ)
+            glstate().bindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self._nextpbo = 0
+        self._pending = [] # pbos with reads in progress, oldest first
+        self._viewport = (gl.GLint*4)()
+        self._previous = gl.GLint(0) # the framebuffer drawn to before
+        
+    def __enter__(self):
+        # draws to the framebuffer, with the viewport set to cover it
+        gl.glGetIntegerv(gl.GL_VIEWPORT, self._viewport)
+        gl.glGetIntegerv(gl.GL_DRAW_FRAMEBUFFER_BINDING, ctypes.byref(self._previous))
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self._fbo)
+        gl.glViewport(0, 0, self.width, self.height)
+        return self
+    
+    def __exit__(self, extype, exvalue, extraceback):
+        # back to drawing where we were before: the window, or the 
+        # framebuffer of an enclosing with block
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self._previous.value)
+        gl.glViewport(*self._viewport)
+        
+    def _empty(self, out):
+        # an array to read pixels into
+        if out is None:
+            out = np.empty((self.height, self.width, 4), dtype=glfloat_dtype)
+        elif out.shape!=(self.height, self.width, 4) or out.dtype!=glfloat_dtype or not out.flags.c_contiguous:
+            raise ValueError(f'out must be a contiguous ({self.height}, {self.width}, 4) {glfloat_dtype} array')
+        return out
+        
+    def read(self, out=None):
+        # reads the pixels into out, or a new array, waiting for drawing to finish
+        out = self._empty(out)
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self._fbo)
+        gl.glReadPixels(0, 0, self.width, self.height, gl.GL_RGBA, gl.GL_FLOAT, 
+                        out.ctypes.data_as(ctypes.c_void_p))
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, 0)
+        return out
+    
+    def startRead(self):
+        # starts copying the pixels into the next pixel pack buffer. If all
+        # the buffers are busy, finishRead has to be called first; reads
+        # are never thrown away.
+        if not self._pbos:
+            raise ValueError('startRead needs pixel pack buffers (pbos>0); use read() instead')
+        if len(self._pending)==len(self._pbos):
+            raise RuntimeError(f'all {len(self._pbos)} reads are in progress; call finishRead() first')
+        pbo = self._pbos[self._nextpbo]
+        self._nextpbo = (self._nextpbo+1)%len(self._pbos)
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self._fbo)
+        glstate().bindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+        gl.glReadPixels(0, 0, self.width, self.height, gl.GL_RGBA, gl.GL_FLOAT, None)
+        glstate().bindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, 0)
+        self._pending.append(pbo)
+        
+    def finishRead(self, out=None):
+        # copies the oldest started read into out (or a new array) and
+        # returns it, or returns None if no read has been started.
+        if not self._pending:
+            return None
+        out = self._empty(out)
+        pbo = self._pending.pop(0)
+        glstate().bindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+        ptr = gl.glMapBufferRange(gl.GL_PIXEL_PACK_BUFFER, 0, self.nbytes, gl.GL_MAP_READ_BIT)
+        ctypes.memmove(out.ctypes.data, ptr, self.nbytes)
+        gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+        glstate().bindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        return out
+    
+    def free(self):
+        gl.glDeleteFramebuffers(1, ctypes.byref(self._fbo))
+        if self._depth.value:
+            gl.glDeleteRenderbuffers(1, ctypes.byref(self._depth))
+        if self._pbos:
+            gl.glDeleteBuffers(len(self._pbos), self._pbos)
+            for pbo in self._pbos:
+                glstate().deleteBuffer(pbo)
+        self.texture.free()
+
+
+# uniform blocks. The GLSL types that can go in a block, as 
+# (numpy dtype, rows, columns), and their std140 alignment in bytes
+_glsl_types = {
+    'float':(glfloat_dtype, 1, 1), 'vec2':(glfloat_dtype, 2, 1), 
+    'vec3':(glfloat_dtype, 3, 1), 'vec4':(glfloat_dtype, 4, 1),
+    'int':(np.dtype(np.int32), 1, 1), 'ivec2':(np.dtype(np.int32), 2, 1), 
+    'ivec3':(np.dtype(np.int32), 3, 1), 'ivec4':(np.dtype(np.int32), 4, 1),
+    'uint':(np.dtype(np.uint32), 1, 1), 'bool':(np.dtype(np.int32), 1, 1),
+    'mat2':(glfloat_dtype, 2, 2), 'mat3':(glfloat_dtype, 3, 3), 'mat4':(glfloat_dtype, 4, 4),
+    }
+_glsl_align = {1:4, 2:8, 3:16, 4:16}
+
+def std140(fields):
+    # works out the std140 layout of a uniform block. fields is a dict of 
+    # name -> glsl type, e.g. 'vec3' or 'float[10]'. Returns the block size
+    # and a dict of name -> (dtype, offset, shape, strides) 
+    layout = {}
+    offset = 0
+    for name, gltype in fields.items():
+        count = None
+        if gltype.endswith(']'):
+            gltype, count = gltype[:-1].split('[')
+            count = int(count)
+        dtype, rows, columns = _glsl_types[gltype]
+        if columns>1:
+            # matrices are stored as an array of column vectors
+            align = 16
+            shape, strides = (rows, columns), (dtype.itemsize, 16)
+            size = 16*columns
+        else:
+            align = _glsl_align[rows]
+            shape, strides = ((rows,), (dtype.itemsize,)) if rows>1 else ((), ())
+            size = rows*dtype.itemsize
+        if count is not None:
+            # array elements are all aligned to 16 bytes
+            align = 16
+            stride = -(-size//16)*16
+            shape, strides = (count,)+shape, (stride,)+strides
+            size = count*stride
+        offset = -(-offset//align)*align
+        layout[name] = (dtype, offset, shape, strides)
+        offset += size
+    return -(-offset//16)*16, layout
+
+
+class UniformBlock:
+    # A uniform block backed by a uniform buffer object. The fields are
+    # given as name=glsl type, in the order they are declared in the shader,
+    # which must use layout(std140), e.g.
+    #   block = UniformBlock('Params', scale='vec2', stripes='int')
+    # matches
+    #   layout(std140) uniform Params { vec2 scale; int stripes; };
+    # Setting block.scale etc. writes into a numpy copy of the block, and
+    # upload() sends the block to GL once, and only if something changed.
+    # The same block can be connected to several programs.
+    def __init__(self, name, binding=0, usage=gl.GL_DYNAMIC_DRAW, **fields):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'binding', binding)
+        size, layout = std140(fields)
+        data = np.zeros(size, dtype=np.uint8)
+        views = {fname:np.ndarray(shape, dtype, data, offset, strides) 
+                 for fname, (dtype, offset, shape, strides) in layout.items()}
+        object.__setattr__(self, 'data', data)
+        object.__setattr__(self, '_views', views)
+        object.__setattr__(self, 'dirty', True)
+        _ubo = gl.GLuint(0)
+        gl.glGenBuffers(1, ctypes.byref(_ubo))
+        object.__setattr__(self, '_ubo', _ubo)
+        glstate().bindBuffer(gl.GL_UNIFORM_BUFFER, _ubo.value)
+        gl.glBufferData(gl.GL_UNIFORM_BUFFER, size, None, usage)
+        gl.glBindBufferBase(gl.GL_UNIFORM_BUFFER, binding, _ubo)
+        glstate().buffers[gl.GL_UNIFORM_BUFFER] = _ubo.value
+        
+    def __getattr__(self, name):
+        # the numpy view of a field
+        try:
+            return self._views[name]
+        except KeyError:
+            raise AttributeError(name) from None
+        
+    def __setattr__(self, name, value):
+        if name not in self._views:
+            raise AttributeError(f'uniform block {self.name} has no field {name}')
+        view = self._views[name]
+        value = np.asarray(value, dtype=view.dtype)
+        if not np.array_equal(view, value):
+            view[...] = value
+            object.__setattr__(self, 'dirty', True)
+            
+    def connectToShader(self, program):
+        # connects the block in the program (a pyshaders program or 
+        # program id) to this buffer
+        pid = getattr(program, 'pid', program)
+        index = gl.glGetUniformBlockIndex(pid, self.name.encode())
+        gl.glUniformBlockBinding(pid, index, self.binding)
+        
+    def upload(self):
+        # sends the block to GL if it has changed
+        if self.dirty:
+            glstate().bindBuffer(gl.GL_UNIFORM_BUFFER, self._ubo.value)
+            gl.glBufferSubData(gl.GL_UNIFORM_BUFFER, 0, self.data.nbytes, 
+                               self.data.ctypes.data_as(ctypes.c_void_p))
+            object.__setattr__(self, 'dirty', False)
+            
+    def free(self):
+        gl.glDeleteBuffers(1, ctypes.byref(self._ubo))
+        glstate().deleteBuffer(self._ubo.value)
+
+
+
+# shader programs. load_program is a replacement for pyshaders.from_string
+# which keeps the linked program binaries on disk, so a program only has to
+# be compiled the first time it is used with a particular driver.
+
+program_cache = os.path.join(os.path.expanduser('~'), '.cache', 'cauldron', 'programs')
+
+def _glstring(name):
+    # a GL string, e.g. gl.GL_RENDERER
+    return ctypes.cast(gl.glGetString(name), ctypes.c_char_p).value or b''
+
+def load_program(vertex_shader, fragment_shader, cachedir=None):
+    # compiles & links the shaders into a pyshaders program, or loads the 
+    # binary of the linked program from cachedir (default program_cache) 
+    # if it is there. The cache is keyed by the shader sources and the GL
+    # vendor, renderer & version, and falls back to compiling if the
+    # driver won't take the cached binary.
+    cachedir = cachedir or program_cache
+    key = hashlib.sha256()
+    for part in (vertex_shader.encode(), fragment_shader.encode(), _glstring(gl.GL_VENDOR), 
+                 _glstring(gl.GL_RENDERER), _glstring(gl.GL_VERSION)):
+        key.update(part)
+        key.update(b'\0')
+    path = os.path.join(cachedir, key.hexdigest()+'.bin')
+    program = _load_binary(path)
+    if program is None:
+        program = _compile_program(vertex_shader, fragment_shader)
+        _save_binary(program, path)
+    return program
+
+def _load_binary(path):
+    # the program from a cached binary, or None if there isn't one or 
+    # the driver rejects it.
+    try:
+        with open(path, 'rb') as f:
+            binary = f.read()
+    except OSError:
+        return None
+    fmt = int.from_bytes(binary[:4], 'little')
+    binary = binary[4:]
+    program = pyshaders.ShaderProgram.new_program()
+    try:
+        gl.glProgramBinary(program.pid, fmt, binary, len(binary))
+    except gl.GLException:
+        # e.g. GL_INVALID_ENUM for a binary format the driver no longer has
+        return None
+    if program.link_status!=gl.GL_TRUE:
+        return None
+    program.uniforms.reload()
+    program.attributes.reload()
+    return program
+
+def _compile_program(vertex_shader, fragment_shader):
+    # as pyshaders.from_string, but asks for the binary to be retrievable
+    shaders = [pyshaders.ShaderObject.vertex(), pyshaders.ShaderObject.fragment()]
+    logs = ''
+    for shader, source in zip(shaders, (vertex_shader, fragment_shader)):
+        shader.source = source
+        if shader.compile() is False:
+            logs += shader.logs
+    if logs:
+        raise pyshaders.ShaderCompilationError(logs)
+    program = pyshaders.ShaderProgram.new_program()
+    program.attach(*shaders)
+    gl.glProgramParameteri(program.pid, gl.GL_PROGRAM_BINARY_RETRIEVABLE_HINT, gl.GL_TRUE)
+    if not program.link():
+        raise pyshaders.ShaderCompilationError(program.logs)
+    return program
+
+def _save_binary(program, path):
+    # writes the program binary to path, prefixed by its 4 byte format.
+    # Failing to cache isn't an error.
+    length = gl.GLint(0)
+    gl.glGetProgramiv(program.pid, gl.GL_PROGRAM_BINARY_LENGTH, ctypes.byref(length))
+    if length.value==0:
+        return
+    binary = ctypes.create_string_buffer(length.value)
+    written = gl.GLsizei(0)
+    fmt = gl.GLenum(0)
+    gl.glGetProgramBinary(program.pid, length, ctypes.byref(written), ctypes.byref(fmt), binary)
+    try:
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # a temporary file of its own, so processes saving the same program
+        # at once don't write over each other's half-written files
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(fmt.value.to_bytes(4, 'little'))
+                f.write(binary.raw[:written.value])
+            os.replace(tmp, path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+    except OSError:
+        pass
+
+
+class ShaderVariants:
+    # Specialised versions of a program, one for each combination of 
+    # feature flags, so the shaders can test the flags with the preprocessor
+    # rather than branching on uniforms. The flags are given defaults 
+    # when the variants are made, e.g.
+    #   variants = ShaderVariants(vertex_shader, fragment_shader, TEXTURES=1, STRIPES=0)
+    # and each is put in the shaders as a #define after the #version line,
+    # with booleans as 1 or 0, so the shaders can say e.g. `#if TEXTURES==2`.
+    # Programs are compiled (with load_program) the first time they are asked for.
+    def __init__(self, vertex_shader, fragment_shader, cachedir=None, **defaults):
+        self.vertex_shader = vertex_shader
+        self.fragment_shader = fragment_shader
+        self.cachedir = cachedir
+        self.defaults = defaults
+        self.programs = {}
+        
+    def program(self, **flags):
+        # the program for the flags; unspecified flags take their defaults
+        for name in flags:
+            if name not in self.defaults:
+                raise ValueError(f'unknown shader flag {name}')
+        flags = {**self.defaults, **flags}
+        key = tuple(sorted(flags.items()))
+        program = self.programs.get(key)
+        if program is None:
+            defines = ''.join(f'#define {name} {int(value) if type(value) is bool else value}\n' 
+                              for name, value in key)
+            program = load_program(_add_defines(self.vertex_shader, defines), 
+                                   _add_defines(self.fragment_shader, defines), 
+                                   self.cachedir)
+            self.programs[key] = program
+        return program
+    
+    def use(self, **flags):
+        # makes the program for the flags the current one & returns it
+        program = self.program(**flags)
+        glstate().useProgram(program)
+        return program
+    
+def _add_defines(source, defines):
+    # puts the defines after the #version line, which has to come first
+    lines = source.splitlines(keepends=True)
+    for i, line in enumerate(lines):
+        if line.strip().startswith('#version'):
+            return ''.join(lines[:i+1])+defines+''.join(lines[i+1:])
+    return defines+source
+
+
+
+class FrameTimer:
+    # Records the timing of every frame in a ring buffer of the last
+    # `frames` frames: when drawing started, the CPU time spent drawing,
+    # the GPU time (from GL_TIME_ELAPSED queries), when the frame was
+    # flipped to the screen, and whether the flip missed its deadline (came
+    # more than half a refresh period later than `interval` after the one
+    # before). interval is how often frames are meant to be drawn, by 
+    # default every refresh. Times are in seconds. Use it like this:
+    #   timer = FrameTimer(window=window)
+    #   @window.event
+    #   def on_draw():
+    #       timer.begin()
+    #       ... draw ...
+    #       timer.end()
+    # The flip times need the window, so the timer can wrap window.flip.
+    # GPU times are read a few frames late so as not to stall the pipeline.
+    # free() deletes the GPU queries.
+    record_dtype = np.dtype([('start','f8'), ('cpu','f8'), ('gpu','f8'), 
+                             ('flip','f8'), ('missed','?')])
+    
+    def __init__(self, frames=3600, refresh_rate=None, window=None, queries=4, 
+                 interval=None):
+        self.records = np.zeros(frames, dtype=self.record_dtype)
+        self.count = 0 # frames recorded so far
+        self.refresh_rate = refresh_rate
+        self.interval = interval
+        self._queries = (gl.GLuint*queries)()
+        self._querying = [None]*queries # the frame each query is timing
+        self._generated = False
+        self._lastflip = None
+        if window is not None:
+            self.attach(window)
+            
+    def attach(self, window):
+        # wraps window.flip so flips are timed. If the refresh rate wasn't
+        # given, it is taken from the screen mode, or else assumed to be 60Hz.
+        if self.refresh_rate is None:
+            try:
+                self.refresh_rate = window.screen.get_mode().rate or 60
+            except Exception:
+                self.refresh_rate = 60
+        flip = window.flip
+        def timedflip():
+            flip()
+            self._flipped(time.perf_counter())
+        window.flip = timedflip
+        
+    def begin(self):
+        # call at the start of drawing a frame
+        if not self._generated:
+            # needs a context, so can't be done in __init__
+            gl.glGenQueries(len(self._queries), self._queries)
+            self._generated = True
+        q = self.count%len(self._queries)
+        if self._querying[q] is not None:
+            self._collect(q)
+        record = self.records[self.count%len(self.records)]
+        record['start'] = time.perf_counter()
+        record['cpu'] = record['gpu'] = record['flip'] = np.nan
+        record['missed'] = False
+        gl.glBeginQuery(gl.GL_TIME_ELAPSED, self._queries[q])
+        self._querying[q] = self.count
+        
+    def end(self):
+        # call when all the frame's draw calls have been made
+        gl.glEndQuery(gl.GL_TIME_ELAPSED)
+        record = self.records[self.count%len(self.records)]
+        record['cpu'] = time.perf_counter()-record['start']
+        self.count += 1
+        
+    def _flipped(self, t):
+        if self.count==0:
+            return
+        record = self.records[(self.count-1)%len(self.records)]
+        record['flip'] = t
+        if self._lastflip is not None:
+            period = 1/self.refresh_rate
+            interval = self.interval or period
+            record['missed'] = t-self._lastflip>interval+0.5*period
+        self._lastflip = t
+        
+    def _collect(self, q):
+        # gets the gpu time from query q, waiting for it if need be
+        frame = self._querying[q]
+        self._querying[q] = None
+        if self.count-frame>len(self.records):
+            return # the record has gone
+        elapsed = ctypes.c_uint64(0)
+        gl.glGetQueryObjectui64v(self._queries[q], gl.GL_QUERY_RESULT, ctypes.byref(elapsed))
+        self.records[frame%len(self.records)]['gpu'] = elapsed.value*1e-9
+        
+    def array(self):
+        # the records, oldest first. Collects any outstanding gpu times.
+        for q, frame in enumerate(self._querying):
+            if frame is not None and frame<self.count:
+                self._collect(q)
+        n = min(self.count, len(self.records))
+        start = self.count-n
+        index = np.arange(start, self.count)%len(self.records)
+        return self.records[index]
+    
+    def summary(self):
+        # a dict of frame timing statistics
+        records = self.array()
+        flips = records['flip'][~np.isnan(records['flip'])]
+        intervals = np.diff(flips)
+        stats = dict(frames=len(records), missed=int(records['missed'].sum()))
+        for name, values in (('cpu', records['cpu']), ('gpu', records['gpu']), 
+                             ('interval', intervals)):
+            values = values[~np.isnan(values)]
+            if len(values):
+                stats[name+'_mean'] = float(values.mean())
+                stats[name+'_max'] = float(values.max())
+        return stats
+    
+    def free(self):
+        if self._generated:
+            gl.glDeleteQueries(len(self._queries), self._queries)
+            self._generated = False
+            self._querying = [None]*len(self._queries)
+
+
+class GLProfiler:
+    # Counts the GL calls cauldron makes, the bytes they upload, and the
+    # time spent in them, per GL function per frame. While profiling,
+    # cauldron's `gl` is swapped for a wrapper that does the counting;
+    # otherwise nothing changes, so it costs nothing when it isn't running.
+    #   profiler = GLProfiler()
+    #   profiler.start()
+    #   ... in on_draw, after drawing: profiler.frame()
+    #   profiler.stop(); print(profiler.summary())
+    def __init__(self):
+        self.frames = [] # one dict of name -> [calls, bytes, seconds] per frame
+        self.current = {}
+        self._gl = None
+        
+    def start(self):
+        global gl
+        if self._gl is None:
+            self._gl = gl
+            gl = _ProfiledGL(self._gl, self)
+            
+    def stop(self):
+        global gl
+        if self._gl is not None:
+            gl = self._gl
+            self._gl = None
+            
+    def frame(self):
+        # ends the current frame's counts
+        self.frames.append(self.current)
+        self.current = {}
+        
+    def summary(self):
+        # a dict of name -> dict of calls, bytes & seconds per frame,
+        # averaged over the frames so far.
+        totals = {}
+        for counts in self.frames:
+            for name, (calls, nbytes, seconds) in counts.items():
+                total = totals.setdefault(name, [0, 0, 0.0])
+                total[0] += calls
+                total[1] += nbytes
+                total[2] += seconds
+        n = max(len(self.frames), 1)
+        return {name:dict(calls=calls/n, bytes=nbytes/n, seconds=seconds/n) 
+                for name, (calls, nbytes, seconds) in totals.items()}
+    
+    def _record(self, name, nbytes, seconds):
+        counts = self.current.get(name)
+        if counts is None:
+            counts = self.current[name] = [0, 0, 0.0]
+        counts[0] += 1
+        counts[1] += nbytes
+        counts[2] += seconds
+        
+# the argument holding the size in bytes, for uploads that give one
+_size_args = {'glBufferData':1, 'glBufferSubData':2, 'glProgramBinary':3}
+        
+class _ProfiledGL:
+    # stands in for pyglet.gl, timing & counting calls to gl functions
+    def __init__(self, gl, profiler):
+        self._gl = gl
+        self._profiler = profiler
+        
+    def __getattr__(self, name):
+        value = getattr(self._gl, name)
+        if name.startswith('gl') and callable(value):
+            value = self._wrap(name, value)
+            setattr(self, name, value) # so __getattr__ isn't called again
+        # anything else, e.g. current_context, is read from pyglet.gl each
+        # time, as it can change
+        return value
+    
+    def _wrap(self, name, function):
+        record = self._profiler._record
+        sizearg = _size_args.get(name)
+        def profiled(*args):
+            start = time.perf_counter()
+            result = function(*args)
+            seconds = time.perf_counter()-start
+            if name=='glBufferData' and args[2] is None:
+                # allocating or orphaning, nothing is uploaded
+                nbytes = 0
+            elif sizearg is not None:
+                nbytes = args[sizearg]
+                nbytes = getattr(nbytes, 'value', nbytes)
+            else:
+                # e.g. texture uploads pass the data as a ctypes array
+                nbytes = sum(ctypes.sizeof(arg) for arg in args if isinstance(arg, ctypes.Array))
+            record(name, nbytes, seconds)
+            return result
+        return profiled
+
+
+# The pixel pipeline (see plans.md). Drawables draw float colours into an
+# offscreen framebuffer, and then one full-screen pass turns them into
+# what is sent to the display, doing all the stages below at once on the
+# GPU. Each stage also has an apply() method doing the same thing to a 
+# numpy array, for checking.
+
+class Contrast:
+    # colours are contrasts against the background (br,bg,bb), in 0...1:
+    # intensity = (contrast+1)*background
+    def __init__(self, br, bg, bb):
+        self.background = np.array((br, bg, bb), dtype=glfloat_dtype)
+        
+    def apply(self, rgb):
+        return (rgb+1)*self.background
+        
+class ColourModel:
+    # converts intensities to rgb by multiplying by a 3x3 matrix
+    def __init__(self, mat):
+        self.matrix = np.asarray(mat, dtype=glfloat_dtype).reshape(3, 3)
+        
+    def apply(self, rgb):
+        return rgb@self.matrix.T
+        
+class Gamma:
+    # gamma correction. Gamma(exponent) corrects for a display with the 
+    # given gamma exponent, which may be one number or one for each of r, g, b.
+    # Gamma(lookup=table) uses a table of n values (or n*3, for r, g, b),
+    # where entry i is the output for intensity i/(n-1), interpolating
+    # between entries. On the GPU the table is a float texture, uploaded once.
+    def __init__(self, exponent=None, lookup=None):
+        if (exponent is None)==(lookup is None):
+            raise ValueError('give one of exponent and lookup')
+        self.exponent = self.lookup = None
+        if exponent is not None:
+            exponent = np.asarray(exponent, dtype=glfloat_dtype)
+            if exponent.shape not in ((), (3,)):
+                raise ValueError('exponent must be one number or one for each of r, g, b')
+            self.exponent = np.broadcast_to(exponent, (3,)).copy()
+        else:
+            lookup = np.asarray(lookup, dtype=glfloat_dtype)
+            if lookup.ndim==1:
+                lookup = lookup[:,None]
+            if lookup.ndim!=2 or lookup.shape[1] not in (1, 3) or len(lookup)<2:
+                raise ValueError('lookup must be n or n*3 values, n>1')
+            self.lookup = np.ascontiguousarray(np.broadcast_to(lookup, (len(lookup), 3)))
+        
+    def apply(self, rgb):
+        if self.lookup is None:
+            return np.maximum(rgb, 0)**(1/self.exponent)
+        n = len(self.lookup)
+        index = np.clip(rgb, 0, 1)*(n-1)
+        lo = np.floor(index).astype(int)
+        hi = np.minimum(lo+1, n-1)
+        frac = index-lo
+        channel = np.arange(3)
+        return self.lookup[lo, channel]*(1-frac)+self.lookup[hi, channel]*frac
+    
+    def texture(self):
+        # the lookup table as a TextureObject. Textures can't be very wide, 
+        # so the table is wrapped onto rows of at most lutwidth entries.
+        n = len(self.lookup)
+        width = min(n, lutwidth)
+        rows = -(-n//width)
+        table = np.zeros((rows*width, 3), dtype=glfloat_dtype)
+        table[:n] = self.lookup
+        return TextureObject(table.reshape(rows, width, 3))
+    
+lutwidth = 4096
+    
+class Device:
+    # packs 16 bit intensities into 8 bit channels for high bit depth
+    # display devices:
+    #  'mono++': red is the high byte & green the low byte of the first channel
+    #  'color++': pairs of pixels give one 16 bit rgb colour, with the high 
+    #             bytes on the left & low bytes on the right. The left pixel
+    #             of each pair is the one used.
+    def __init__(self, mode):
+        if mode not in ('mono++', 'color++'):
+            raise ValueError(f'unknown device mode {mode}')
+        self.mode = mode
+        
+    def apply(self, rgb):
+        # rgb is a (height, width, 3) image
+        rgb = np.asarray(rgb, dtype=glfloat_dtype)
+        out = np.zeros_like(rgb)
+        if self.mode=='mono++':
+            out[...,0], out[...,1] = _split16(rgb[...,0])
+        else:
+            left = np.repeat(rgb[...,::2,:], 2, axis=-2)[...,:rgb.shape[-2],:]
+            high, low = _split16(left)
+            out[...,::2,:] = high[...,::2,:]
+            out[...,1::2,:] = low[...,1::2,:]
+        return out
+    
+def _split16(c):
+    # the high & low bytes of c as a 16 bit number, as 8 bit colour values
+    value = np.floor(np.clip(c, 0, 1)*65535+0.5)
+    high = np.floor(value/256)
+    return high/255, (value-high*256)/255
+    
+
+_pipeline_vertex_shader = '''
+    #version 300 es
+    precision highp float;
+    layout(location = 0) in vec2 position;
+    
+    void main()
+    {
+        gl_Position = vec4(position, 0.0, 1.0);
+    }
+'''
+
+_pipeline_fragment_shader = '''
+    #version 300 es
+    precision highp float;
+    
+    out vec4 fColor;
+    uniform sampler2D image;
+    #if CONTRAST
+    uniform vec3 background;
+    #endif
+    #if COLOURMODEL
+    uniform mat3 colourmatrix;
+    #endif
+    #if GAMMA
+    uniform vec3 invgamma;
+    #endif
+    #if GAMMALUT
+    uniform sampler2D gammatable;
+    uniform int lutsize;
+    
+    vec3 lookup(vec3 colour)
+    {
+        // the table is wrapped onto rows, so entry k is at (k%width, k/width)
+        int width = textureSize(gammatable, 0).x;
+        vec3 index = clamp(colour, 0.0, 1.0)*float(lutsize-1);
+        vec3 lo = floor(index);
+        vec3 result;
+        for (int i=0; i<3; i++) {
+            int k = int(lo[i]);
+            int k1 = min(k+1, lutsize-1);
+            float a = texelFetch(gammatable, ivec2(k%width, k/width), 0)[i];
+            float b = texelFetch(gammatable, ivec2(k1%width, k1/width), 0)[i];
+            result[i] = mix(a, b, index[i]-lo[i]);
+        }
+        return result;
+    }
+    #endif
+    #if DEVICE
+    vec2 split16(float c)
+    {
+        // the high & low bytes of c as a 16 bit number
+        float value = floor(clamp(c, 0.0, 1.0)*65535.0+0.5);
+        float high = floor(value/256.0);
+        return vec2(high, value-high*256.0)/255.0;
+    }
+    #endif
+    
+    void main()
+    {
+        ivec2 xy = ivec2(gl_FragCoord.xy);
+        #if DEVICE==2
+        xy.x -= xy.x%2; // color++ uses the left pixel of each pair
+        #endif
+        vec4 pixel = texelFetch(image, xy, 0);
+        vec3 colour = pixel.rgb;
+        #if CONTRAST
+        colour = (colour+1.0)*background;
+        #endif
+        #if COLOURMODEL
+        colour = colourmatrix*colour;
+        #endif
+        #if GAMMA
+        colour = pow(max(colour, 0.0), invgamma);
+        #endif
+        #if GAMMALUT
+        colour = lookup(colour);
+        #endif
+        #if DEVICE==1
+        vec2 mono = split16(colour.r);
+        fColor = vec4(mono, 0.0, 1.0);
+        #elif DEVICE==2
+        vec2 r = split16(colour.r);
+        vec2 g = split16(colour.g);
+        vec2 b = split16(colour.b);
+        if (int(gl_FragCoord.x)%2==0) {
+            fColor = vec4(r.x, g.x, b.x, 1.0);
+        } else {
+            fColor = vec4(r.y, g.y, b.y, 1.0);
+        }
+        #else
+        fColor = vec4(colour, pixel.a);
+        #endif
+    }
+'''
+
+class PixelPipeline:
+    # Runs the pixel pipeline stages, e.g.
+    #   pipeline = PixelPipeline(window.width, window.height, Contrast(0.5,0.5,0.5), Gamma(2.2))
+    #   with pipeline:
+    #       ... draw as usual ...
+    # Drawing inside the with block goes to a float framebuffer the size of
+    # the window, and at the end of the block the stages are applied in one
+    # full-screen pass into the window. Omitted stages cost nothing, as the
+    # pass is compiled without them. If you change a stage, call configure().
+    def __init__(self, width, height, *stages):
+        self.fbo = FrameBufferObject(width, height, pbos=0) # never read back
+        self.quad = VertexArrayObject()
+        corners = self.quad.createBuffer(data=((-1,-1),(1,-1),(-1,1),(1,1)))
+        corners.connectToShader(location=0)
+        self.variants = ShaderVariants(_pipeline_vertex_shader, _pipeline_fragment_shader, 
+                                       CONTRAST=False, COLOURMODEL=False, GAMMA=False, 
+                                       GAMMALUT=False, DEVICE=0)
+        self.stages = stages
+        self.lut = None
+        self.configure()
+        
+    def _stage(self, kind):
+        for stage in self.stages:
+            if isinstance(stage, kind):
+                return stage
+        return None
+        
+    def configure(self):
+        # picks the program for the stages & sets its uniforms, putting the
+        # program that was in use back afterwards
+        previous = glstate().currentProgram()
+        contrast, colourmodel, gamma, device = (self._stage(kind) for kind in 
+                                                (Contrast, ColourModel, Gamma, Device))
+        lookup = gamma is not None and gamma.lookup is not None
+        self.program = self.variants.use(CONTRAST=contrast is not None, 
+                                         COLOURMODEL=colourmodel is not None, 
+                                         GAMMA=gamma is not None and not lookup,
+                                         GAMMALUT=lookup,
+                                         DEVICE=0 if device is None else 
+                                                ('mono++', 'color++').index(device.mode)+1)
+        uniforms = self.program.uniforms
+        if contrast is not None:
+            gl.glUniform3f(uniforms['background'].loc, *contrast.background)
+        if colourmodel is not None:
+            # numpy is row major, GL column major, hence the transpose
+            gl.glUniformMatrix3fv(uniforms['colourmatrix'].loc, 1, gl.GL_TRUE, 
+                                  colourmodel.matrix.ctypes.data_as(ctypes.POINTER(gl.GLfloat)))
+        if self.lut is not None:
+            self.lut.free()
+            self.lut = None
+        if lookup:
+            self.lut = gamma.texture()
+            gl.glUniform1i(uniforms['lutsize'].loc, len(gamma.lookup))
+        elif gamma is not None:
+            gl.glUniform3f(uniforms['invgamma'].loc, *(1/gamma.exponent))
+        glstate().useProgram(previous)
+            
+    def apply(self, rgb):
+        # what the pipeline does, for checking: rgb is an array of 
+        # colours (last dimension 3) from the drawables, which has to be
+        # a (height, width, 3) image if there is a color++ Device.
+        rgb = np.asarray(rgb, dtype=glfloat_dtype)
+        for kind in (Contrast, ColourModel, Gamma, Device):
+            stage = self._stage(kind)
+            if stage is not None:
+                rgb = stage.apply(rgb)
+        return rgb
+            
+    def __enter__(self):
+        self.fbo.__enter__()
+        return self
+    
+    def __exit__(self, extype, exvalue, extraceback):
+        self.fbo.__exit__(extype, exvalue, extraceback)
+        self.draw()
+        
+    def draw(self):
+        # the full-screen pass. The program in use is put back afterwards, 
+        # so scenes that use() their program once still draw with it.
+        previous = glstate().currentProgram()
+        depthtest = gl.glIsEnabled(gl.GL_DEPTH_TEST)
+        gl.glDisable(gl.GL_DEPTH_TEST)
+        glstate().useProgram(self.program)
+        self.fbo.texture.connectToShader(self.program.uniforms['image'])
+        if self.lut is not None:
+            self.lut.connectToShader(self.program.uniforms['gammatable'])
+        self.quad.drawArrays(mode=gl.GL_TRIANGLE_STRIP)
+        self.fbo.texture.disconnect()
+        if self.lut is not None:
+            self.lut.disconnect()
+        if depthtest:
+            gl.glEnable(gl.GL_DEPTH_TEST)
+        glstate().useProgram(previous)
+            
+    def free(self):
+        self.fbo.free()
+        if self.lut is not None:
+            self.lut.free()
+
+
+class TextureArrayObject:
+    # A GL_TEXTURE_2D_ARRAY: a stack of same-size images (layers) that a
+    # shader can sample as one texture. Like TextureObject, the storage is
+    # immutable, the data is set with sub-image calls, and the data types
+    # and internalformat are as for TextureObject.
+    def __init__(self, data=None, internalformat=None):
+        _tex = gl.GLuint(0)
+        gl.glGenTextures(1, ctypes.byref(_tex))
+        self._tex = _tex
+        self.internalformat = internalformat
+        self.storage = None
+        self.shape = None # layers, height, width
+        self.texunit = -1
+        if data is not None:
+            self.setData(data)
+            
+    def __enter__(self):
+        glstate().bindTexture(gl.GL_TEXTURE_2D_ARRAY, self._tex.value)
+        return self
+    
+    def __exit__(self, extype, exvalue, extraceback):
+        if not cache_state:
+            glstate().bindTexture(gl.GL_TEXTURE_2D_ARRAY, 0)
+            
+    def _allocate(self, layers, height, width, internalformat):
+        if self.shape is not None:
+            gl.glDeleteTextures(1, ctypes.byref(self._tex))
+            glstate().deleteTexture(self._tex.value)
+            _tex = gl.GLuint(0)
+            gl.glGenTextures(1, ctypes.byref(_tex))
+            self._tex = _tex
+        self.shape = (layers, height, width)
+        self.storage = internalformat
+        with self:
+            levels = 1
+            gl.glTexStorage3D(gl.GL_TEXTURE_2D_ARRAY, levels, self.storage, 
+                              width, height, layers)
+            gl.glTexParameterf(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+            gl.glTexParameterf(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+            
+    def setData(self, data):
+        # data is a (layers, height, width) or (layers, height, width, 
+        # channels) array
+        data, _ = numpy2ctypes(np.asarray(data))
+        layers, height, width = len(data), len(data[0]), len(data[0][0])
+        internalformat = self.internalformat or texture_format(data, ndim=3)[0]
+        if ((layers, height, width), internalformat)!=(self.shape, self.storage):
+            self._allocate(layers, height, width, internalformat)
+        self._subImage(data, 0, layers, texture_format(data, ndim=3))
+        
+    def setLayer(self, layer, data):
+        # replaces one layer with a (height, width) or (height, width, 
+        # channels) array
+        data, _ = numpy2ctypes(np.asarray(data))
+        if (len(data), len(data[0]))!=self.shape[1:]:
+            raise ValueError(f'layer must be {self.shape[1]}x{self.shape[2]}')
+        self._subImage(data, layer, 1, texture_format(data))
+        
+    def _subImage(self, data, layer, layers, formats):
+        _, format, type = formats
+        alignment = unpack_alignment(ctypes.sizeof(data)//(layers*self.shape[1]))
+        with self:
+            level = 0
+            if alignment!=4:
+                gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, alignment)
+            gl.glTexSubImage3D(gl.GL_TEXTURE_2D_ARRAY, level, 0, 0, layer, 
+                               self.shape[2], self.shape[1], layers, 
+                               format, type, data)
+            if alignment!=4:
+                gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
+            
+    def connectToShader(self, uniform):
+        # as for TextureObject
+        uloc = uniform.loc.value
+        self.texunit = gl.GL_TEXTURE0+uloc
+        glstate().activeTexture(self.texunit)
+        glstate().bindTexture(gl.GL_TEXTURE_2D_ARRAY, self._tex.value)
+        gl.glUniform1i(uloc, uloc)
+        
+    def disconnect(self):
+        glstate().activeTexture(self.texunit)
+        glstate().bindTexture(gl.GL_TEXTURE_2D_ARRAY, 0)
+        
+    def free(self):
+        gl.glDeleteTextures(1, ctypes.byref(self._tex))
+        glstate().deleteTexture(self._tex.value)
+        
+
+_imagestack_vertex_shader = '''
+    #version 300 es
+    precision highp float;
+    layout(location = 0) in vec2 position;
+    layout(location = 1) in vec2 tex_coord;
+    out vec2 tcoord;
+    
+    void main()
+    {
+        gl_Position = vec4(position, 0.5, 1.0);
+        tcoord = tex_coord;
+    }
+'''
+
+# tracing. A function of space & time f(x, y, t) written with python 
+# arithmetic and numpy functions, e.g.
+#   lambda x, y, t: np.exp(-(x**2+y**2)/0.1)*np.sin(20*x+4*t)
+# can be called with Expressions instead of numbers, which records what it
+# does; the record is then turned into GLSL so the function can be worked
+# out in the fragment shader. The same function still works on numpy
+# arrays, which can be used to check what the shader does.
+
+class Expression:
+    # a traced expression: op is 'var', 'const', an operator, or a glsl
+    # function name, and args are its operands.
+    def __init__(self, op, *args):
+        self.op = op
+        self.args = args
+        
+    def __add__(self, other): return Expression('+', self, other)
+    def __radd__(self, other): return Expression('+', other, self)
+    def __sub__(self, other): return Expression('-', self, other)
+    def __rsub__(self, other): return Expression('-', other, self)
+    def __mul__(self, other): return Expression('*', self, other)
+    def __rmul__(self, other): return Expression('*', other, self)
+    def __truediv__(self, other): return Expression('/', self, other)
+    def __rtruediv__(self, other): return Expression('/', other, self)
+    def __pow__(self, other): return Expression('pow', self, other)
+    def __rpow__(self, other): return Expression('pow', other, self)
+    def __mod__(self, other): return Expression('mod', self, other)
+    def __rmod__(self, other): return Expression('mod', other, self)
+    def __neg__(self): return Expression('neg', self)
+    def __pos__(self): return self
+    def __abs__(self): return Expression('abs', self)
+    
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        # numpy functions of expressions are expressions
+        if method!='__call__' or ufunc.__name__ not in _glsl_ufuncs or kwargs:
+            return NotImplemented
+        return Expression(_glsl_ufuncs[ufunc.__name__], *inputs)
+    
+    def glsl(self):
+        # the expression as GLSL source
+        if self.op=='var':
+            return self.args[0]
+        if self.op=='const':
+            return _glsl(self.args[0])
+        args = [_glsl(arg) for arg in self.args]
+        if self.op in ('+', '-', '*', '/'):
+            return f'({args[0]}{self.op}{args[1]})'
+        if self.op=='neg':
+            return f'(-{args[0]})'
+        if self.op=='pow' and _is_integer(self.args[1]):
+            return _glsl_integer_power(args[0], int(self.args[1]))
+        return f'{self.op}({", ".join(args)})'
+    
+def _is_integer(value):
+    # whether value is a number (python or numpy) with an integer value
+    return (not isinstance(value, Expression) and np.ndim(value)==0 and 
+            float(value).is_integer())
+
+def _glsl_integer_power(base, n):
+    # GLSL for base**n. pow() isn't defined for negative bases, so small
+    # powers are multiplied out, and larger ones take pow() of abs(base)
+    # with the sign put back for odd n.
+    if n==0:
+        return '1.0'
+    m = abs(n)
+    if m<=4:
+        power = '('+'*'.join([base]*m)+')'
+    elif m%2:
+        power = f'(sign({base})*pow(abs({base}), {float(m)!r}))'
+    else:
+        power = f'pow(abs({base}), {float(m)!r})'
+    return power if n>0 else f'(1.0/{power})'
+
+def _glsl(value):
+    # GLSL for an expression or a number
+    if isinstance(value, Expression):
+        return value.glsl()
+    return repr(float(value))
+
+# numpy ufuncs with GLSL equivalents
+_glsl_ufuncs = {
+    'add':'+', 'subtract':'-', 'multiply':'*', 'true_divide':'/', 'divide':'/',
+    'negative':'neg', 'power':'pow', 'remainder':'mod', 'absolute':'abs', 
+    'sin':'sin', 'cos':'cos', 'tan':'tan', 'arcsin':'asin', 'arccos':'acos', 
+    'arctan':'atan', 'arctan2':'atan', 'sinh':'sinh', 'cosh':'cosh', 'tanh':'tanh',
+    'exp':'exp', 'exp2':'exp2', 'log':'log', 'log2':'log2', 'sqrt':'sqrt', 
+    'floor':'floor', 'ceil':'ceil', 'sign':'sign', 'minimum':'min', 'maximum':'max',
+    }
+
+def trace(function):
+    # calls function(x, y, t) with Expressions, giving an Expression
+    result = function(Expression('var', 'x'), Expression('var', 'y'), Expression('var', 't'))
+    if not isinstance(result, Expression):
+        result = Expression('const', result)
+    return result
+
+def function2glsl(function, name):
+    # a GLSL function `float name(float x, float y, float t)` that works out
+    # the traced function
+    return (f'float {name}(float x, float y, float t)\n'
+            f'    {{\n        return {trace(function).glsl()};\n    }}\n')
+
+
+_imagestack_fragment_shader = '''
+    #version 300 es
+    precision highp float;
+    precision highp sampler2DArray;
+    
+    in vec2 tcoord;
+    out vec4 fColor;
+    uniform sampler2DArray layers;
+    uniform int modes[LAYERS];
+    uniform float weights[LAYERS];
+    uniform float t;
+    
+    vec3 composite(vec3 colour, vec3 layer, int mode, float weight)
+    {
+        if (mode==0) { // add
+            return colour+weight*layer;
+        } else if (mode==1) { // multiply
+            return colour*mix(vec3(1.0), layer, weight);
+        } else { // mix
+            return mix(colour, layer, weight);
+        }
+    }
+    
+    FUNCTIONS
+    
+    void main()
+    {
+        float x = tcoord.x*2.0-1.0;
+        float y = tcoord.y*2.0-1.0;
+        vec3 colour = weights[0]*texture(layers, vec3(tcoord, 0.0)).rgb;
+        LAYERS_CODE
+        fColor = vec4(colour, 1.0);
+    }
+'''
+
+class ImageStack:
+    # An image composited from a base image and a series of other images
+    # of the same size (see plans.md), e.g.
+    #   stack = ImageStack(base, ('add', grating), ('multiply', envelope, 0.5))
+    # Each composite is (mode, data) or (mode, data, weight); the modes are
+    #   'add':      colour + weight*layer
+    #   'multiply': colour * (1 + weight*(layer-1))
+    #   'mix':      colour + weight*(layer-colour)
+    # data can also be a function f(x, y, t) of space and time, which is
+    # traced and worked out per pixel in the fragment shader (as a grey 
+    # layer). x & y go from -1 to 1 across the image, and t is the time in 
+    # seconds given to draw, or by default since the stack was made.
+    # All the data layers are held in one TextureArrayObject and everything
+    # is composited in one pass, however many layers there are. Weights can
+    # be changed each frame with setWeight, which costs one uniform upload
+    # on the next draw.
+    # The image is drawn into the rectangle (left, bottom, right, top), in
+    # GL coordinates.
+    modes = {'add':0, 'multiply':1, 'mix':2}
+    
+    def __init__(self, data, *composites, rect=(-1, -1, 1, 1)):
+        layers = [np.asarray(data)]
+        modes = [0]
+        weights = [1.0]
+        functions = []
+        code = []
+        for i, composite in enumerate(composites, 1):
+            mode, layer = composite[:2]
+            if callable(layer):
+                name = f'layer{i}'
+                functions.append(function2glsl(layer, name))
+                value = f'vec3({name}(x, y, t))'
+            else:
+                value = f'texture(layers, vec3(tcoord, {float(len(layers))!r})).rgb'
+                layers.append(np.asarray(layer))
+            code.append(f'colour = composite(colour, {value}, modes[{i}], weights[{i}]);')
+            modes.append(self.modes[mode])
+            weights.append(composite[2] if len(composite)>2 else 1.0)
+        self.texture = TextureArrayObject(np.stack(layers))
+        self._modes = np.array(modes, dtype=np.int32)
+        self._weights = np.array(weights, dtype=glfloat_dtype)
+        self._dirty = True
+        self.start = time.perf_counter()
+        left, bottom, right, top = rect
+        self.vao = VertexArrayObject()
+        self.vao.createBuffer(data=((left,bottom),(right,bottom),(right,top),(left,top))).connectToShader(location=0)
+        self.vao.createBuffer(data=((0,0),(1,0),(1,1),(0,1))).connectToShader(location=1)
+        fragment_shader = (_imagestack_fragment_shader
+                           .replace('FUNCTIONS', '\n    '.join(functions))
+                           .replace('LAYERS_CODE', '\n        '.join(code))
+                           .replace('LAYERS', str(len(modes))))
+        self.program = load_program(_imagestack_vertex_shader, fragment_shader)
+        
+    def setWeight(self, layer, weight):
+        if self._weights[layer]!=weight:
+            self._weights[layer] = weight
+            self._dirty = True
+            
+    def setMode(self, layer, mode):
+        if self._modes[layer]!=self.modes[mode]:
+            self._modes[layer] = self.modes[mode]
+            self._dirty = True
+            
+    def setLayer(self, layer, data):
+        # replaces the data for one data layer (0 is the base image, and
+        # function layers aren't counted)
+        self.texture.setLayer(layer, data)
+        
+    def draw(self, t=None):
+        # draws the stack, then puts back the program that was in use
+        previous = glstate().currentProgram()
+        glstate().useProgram(self.program)
+        uniforms = self.program.uniforms
+        if self._dirty:
+            gl.glUniform1iv(uniforms['modes'].loc, len(self._modes), 
+                            self._modes.ctypes.data_as(ctypes.POINTER(gl.GLint)))
+            gl.glUniform1fv(uniforms['weights'].loc, len(self._weights), 
+                            self._weights.ctypes.data_as(ctypes.POINTER(gl.GLfloat)))
+            self._dirty = False
+        if 't' in uniforms:
+            # only there if a function uses it
+            gl.glUniform1f(uniforms['t'].loc, time.perf_counter()-self.start if t is None else t)
+        self.texture.connectToShader(uniforms['layers'])
+        self.vao.drawArrays(mode=gl.GL_TRIANGLE_FAN)
+        self.texture.disconnect()
+        glstate().useProgram(previous)
+        
+    def free(self):
+        self.texture.free()
+
+
+# movies. A sequence of frames too big to load is memory mapped, and frames
+# are copied out of the file by a background thread a few frames ahead of
+# when they are wanted, so showing a frame only has to upload it.
+
+class MovieSource:
+    # Frames from a .npy file of shape (frames, height, width, 3), or from a
+    # raw file of frames if shape=(height, width, 3) and dtype are given, e.g.
+    #   movie = MovieSource('frames.npy', prefetch=4)
+    #   ...
+    #   movie.show(k)       # in on_draw
+    #   movie.texture.connectToShader(program.uniforms['tex'])
+    # show(k) uploads frame k into movie.texture, waiting for it if it
+    # hasn't been read yet, and asks for the next prefetch frames. Frames 
+    # are read into prefetch+1 reusable staging arrays, of the file's type 
+    # if it is one of the gl_types (so uint8 frames upload as uint8) and 
+    # float otherwise. The texture uploads through pixel buffers, so show 
+    # doesn't wait for the transfer either.
+    def __init__(self, filename, shape=None, dtype=None, prefetch=4, pbos=2):
+        if shape is None:
+            self.frames = np.load(filename, mmap_mode='r')
+        else:
+            self.frames = np.memmap(filename, dtype=dtype, mode='r').reshape((-1,)+tuple(shape))
+        dtype = self.frames.dtype if self.frames.dtype in gl_types else glfloat_dtype
+        self.prefetch = prefetch
+        self.texture = TextureObject(pbos=pbos)
+        self.current = None
+        self._ready = {}    # frame number: staging array holding it
+        self._wanted = []   # frames still to read, soonest first
+        self._window = ()   # frames to keep
+        self._reading = None
+        self._errors = {}   # frame number: what went wrong reading it
+        self._free = [np.empty(self.frames.shape[1:], dtype=dtype) 
+                      for _ in range(prefetch+1)]
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        
+    def __len__(self):
+        return len(self.frames)
+    
+    def show(self, k):
+        # uploads frame k to the texture. Errors reading the frame are
+        # raised here.
+        if not 0<=k<len(self.frames):
+            raise IndexError(f'frame {k} is not in 0-{len(self.frames)-1}')
+        if k==self.current:
+            return
+        with self._condition:
+            if self._closed:
+                raise ValueError('the movie has been closed')
+            self._request(k)
+            while k not in self._ready:
+                if k in self._errors:
+                    # it will be read again if asked for again
+                    raise self._errors.pop(k)
+                self._condition.wait()
+            frame = self._ready[k]
+        # the frame stays in the window until the next show, so the reading
+        # thread won't reuse its staging array while it is uploaded.
+        self.texture.setData(frame)
+        self.current = k
+        
+    def _request(self, k):
+        # makes frames k to k+prefetch the window, freeing frames outside it.
+        # Called with the condition held.
+        self._window = range(k, min(k+self.prefetch+1, len(self.frames)))
+        for j in list(self._ready):
+            if j not in self._window:
+                self._free.append(self._ready.pop(j))
+        for j in list(self._errors):
+            if j not in self._window:
+                del self._errors[j]
+        self._wanted = [j for j in self._window 
+                        if j not in self._ready and j not in self._errors 
+                        and j!=self._reading]
+        self._condition.notify_all()
+        
+    def _run(self):
+        # the reading thread
+        while True:
+            with self._condition:
+                while not self._closed and not (self._wanted and self._free):
+                    self._condition.wait()
+                if self._closed:
+                    return
+                k = self._reading = self._wanted.pop(0)
+                buffer = self._free.pop()
+            # reading from the file happens here, outside the lock; numpy
+            # lets go of the GIL while it copies.
+            try:
+                np.copyto(buffer, self.frames[k], casting='unsafe')
+                error = None
+            except Exception as e:
+                # kept for show to raise, and the thread carries on
+                error = e
+            with self._condition:
+                self._reading = None
+                if k in self._window and error is None:
+                    self._ready[k] = buffer
+                else:
+                    self._free.append(buffer)
+                    if k in self._window:
+                        self._errors[k] = error
+                self._condition.notify_all()
+                
+    def close(self):
+        # stops the reading thread
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        
+    def free(self):
+        self.close()
+        self.texture.free()
+
+
+# producing frames. Stimuli that have to be worked out afresh each frame
+# are made ahead of time off the render thread, so on_draw only uploads.
+
+class FrameProducer:
+    # Makes frame after frame of an array with generate(k, out), which
+    # fills out (an array of shape & dtype) with frame k, e.g.
+    #   def noise(k, out):
+    #       rng.random(out=out)
+    #   producer = FrameProducer(noise, (20, 20, 3))
+    #   ...
+    #   texture.setData(producer.next())    # in on_draw
+    # There are `buffers` reusable arrays: the one next() last returned,
+    # which stays valid until next() is called again, and the others being
+    # filled with the following frames. By default one worker thread fills
+    # them, in order, so generate can keep state between frames. With 
+    # processes>0 the arrays are in shared memory and a pool of that many
+    # processes fills them, several frames at once, for heavy numpy work 
+    # that would hold the GIL; generate then has to be a picklable (module
+    # level) function, and should only depend on k.
+    def __init__(self, generate, shape, dtype=glfloat_dtype, buffers=3, processes=0):
+        self.generate = generate
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._memory = []
+        if processes:
+            nbytes = max(int(np.prod(self.shape))*self.dtype.itemsize, 1)
+            self._memory = [shared_memory.SharedMemory(create=True, size=nbytes) 
+                            for _ in range(buffers)]
+            self._buffers = [np.ndarray(self.shape, self.dtype, buffer=memory.buf)
+                             for memory in self._memory]
+            self._executor = concurrent.futures.ProcessPoolExecutor(processes)
+        else:
+            self._buffers = [np.empty(self.shape, self.dtype) for _ in range(buffers)]
+            self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.frame = -1         # the frame next() last returned
+        self._next = 0          # the next frame to start on
+        self._current = None    # the buffer next() last returned
+        self._pending = collections.deque()
+        for i in range(buffers):
+            self._submit(i)
+            
+    def _submit(self, i):
+        # starts filling buffer i with the next frame
+        if self._memory:
+            future = self._executor.submit(_produce_shared, self.generate, 
+                                           self._memory[i].name, self.shape, 
+                                           self.dtype, self._next)
+        else:
+            future = self._executor.submit(self.generate, self._next, self._buffers[i])
+        self._pending.append((i, future))
+        self._next += 1
+        
+    def next(self):
+        # the array holding the next frame, waiting for it if it isn't done.
+        # Errors in generate are raised here.
+        if self._current is not None:
+            self._submit(self._current)
+        i, future = self._pending.popleft()
+        # the slot goes back in the ring on the next call even if generate
+        # failed, so a failed frame is skipped rather than stopping everything
+        self._current = i
+        self.frame += 1
+        future.result()
+        return self._buffers[i]
+    
+    def close(self):
+        # stops the workers & frees the shared memory. The arrays returned 
+        # by next() can't be used after this in process mode.
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._pending.clear()
+        self._buffers = []
+        for memory in self._memory:
+            memory.close()
+            memory.unlink()
+        self._memory = []
+
+def _produce_shared(generate, name, shape, dtype, k):
+    # fills the shared memory called name with frame k, in a worker process
+    memory = shared_memory.SharedMemory(name=name)
+    out = np.ndarray(shape, dtype, buffer=memory.buf)
+    try:
+        generate(k, out)
+    finally:
+        del out
+        memory.close()
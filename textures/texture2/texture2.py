@@ -10,15 +10,16 @@ using the texture objects in cauldron.
 
 import pyglet
 from pyglet import gl
-import pyshaders
 import numpy as np
-from cauldron import VertexArrayObject, TextureObject
+from cauldron import VertexArrayObject, TextureObject, ShaderVariants, FrameTimer, FrameProducer
 
 config = pyglet.gl.Config(sample_buffers=1, samples=4)
 window = pyglet.window.Window(width=300, height=600, config=config)
 
 # SHADERS - color and texture
 # use texelfetch to treat a texture like an array.
+# The number of textures and the stripe spacing are shader variant flags,
+# so each combination gets its own program with no branching per pixel.
 
 def setup_program():
     
@@ -45,32 +46,30 @@ def setup_program():
         in vec2 tcoord;
         out vec4 fColor;
         
-        uniform int stripes;
         uniform sampler2D texture;
+        #if TEXTURES==2
         uniform sampler2D texture1;
-        uniform int activetextures;
+        #endif
                 
         void main()
         {
             // maybe use texelFetch() for images
-            if (activetextures==2) {
-                fColor = mix(texture2D(texture,tcoord), texture2D(texture1,tcoord), 0.2);
-            } else {
-                fColor = texture2D(texture,tcoord);
-            }
-            if (stripes>1) {
-                if (int(gl_FragCoord.x)%stripes==0) {
-                    fColor = vec4(0,0,0,1);
-                }  
-            }
+            #if TEXTURES==2
+            fColor = mix(texture2D(texture,tcoord), texture2D(texture1,tcoord), 0.2);
+            #else
+            fColor = texture2D(texture,tcoord);
+            #endif
+            #if STRIPES>1
+            if (int(gl_FragCoord.x)%STRIPES==0) {
+                fColor = vec4(0,0,0,1);
+            }  
+            #endif
         }
     '''
 
-    program = pyshaders.from_string(vertex_shader, fragment_shader)
-    program.use()
-    return program
+    return ShaderVariants(vertex_shader, fragment_shader, TEXTURES=1, STRIPES=0)
 
-program = setup_program()
+variants = setup_program()
 
 # VERTICES
 
@@ -85,14 +84,12 @@ texcoords = VAO.createBuffer(data=((0,0),(1,0),(1,1),(0,1)))
 texcoords.connectToShader(location=1)
 
 VAO2 = VertexArrayObject()
-# vertices
-_vertices = VAO2.createBuffer(data=(((-0.6+0.1, -0.5, 0.6), (0.6+0.1, -0.5, 0.6), 
-                                  (0.6+0.1, 0.5, 0.6),(-0.6+0.1, 0.5, 0.6))))
-_vertices.connectToShader(location=0)
-
-# texture coords mapping vertices to texture locations
-texcoords = VAO2.createBuffer(data=((0,0),(1,0),(1,1),(0,1)))
-texcoords.connectToShader(location=1)
+# vertices and texture coords interleaved in one buffer
+_vertices = VAO2.createInterleavedBuffer(data={
+    'position':((-0.6+0.1, -0.5, 0.6), (0.6+0.1, -0.5, 0.6), 
+                (0.6+0.1, 0.5, 0.6),(-0.6+0.1, 0.5, 0.6)),
+    'tex_coord':((0,0),(1,0),(1,1),(0,1))})
+_vertices.connectToShader(position=0, tex_coord=1)
 
 
 # TEXTURE
@@ -100,37 +97,48 @@ texcoords.connectToShader(location=1)
 TEX = TextureObject()
 TEX.setData(np.array( (((1,0,0),(0,1,0)),((0.5,0.5,0),(1,1,0)) ) ))
 
-TEX2 = TextureObject()
+TEX2 = TextureObject(pbos=2) # refreshed every frame, so stage uploads
 TEX2.setData(np.random.rand(20,20,3))
 
+# the noise for TEX2 is made ahead of time by a worker thread, so on_draw
+# only has to upload it.
+rng = np.random.default_rng()
+def noise(k, out):
+    rng.random(out=out, dtype=out.dtype)
+producer = FrameProducer(noise, (20,20,3))
+
 TEX3 = TextureObject()
 TEX3.setData(np.random.rand(10,10,3))
 
 # RUN 
-if window.width>window.height:
-    program.uniforms.scale=[window.width/window.height,1]
-else:
-    program.uniforms.scale=[1, window.height/window.width]
+for flags in (dict(TEXTURES=2, STRIPES=10), dict(TEXTURES=1, STRIPES=0)):
+    program = variants.use(**flags)
+    if window.width>window.height:
+        program.uniforms.scale=[window.width/window.height,1]
+    else:
+        program.uniforms.scale=[1, window.height/window.width]
+
+timer = FrameTimer(window=window, interval=1/10) # redrawn 10 times a second
 
 @window.event
 def on_draw():
+    timer.begin()
     gl.glClearColor(0.5, 0.6, 0.7, 1.0)
     gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+    program = variants.use(TEXTURES=2, STRIPES=10)
     TEX.connectToShader(program.uniforms['texture']) 
     TEX3.connectToShader(program.uniforms['texture1']) 
-    program.uniforms.stripes = 10
-    program.uniforms.activetextures = 2
     VAO.drawArrays(mode=gl.GL_TRIANGLE_FAN) 
     TEX.disconnect()
     TEX3.disconnect()
     # next image
-    TEX2.setData(np.random.rand(20,20,3))
+    TEX2.setData(producer.next())
+    program = variants.use(TEXTURES=1, STRIPES=0)
     TEX2.connectToShader(program.uniforms['texture']) 
-    program.uniforms.stripes = 0
-    program.uniforms.activetextures = 1
     VAO2.drawArrays(mode=gl.GL_TRIANGLE_FAN) 
     TEX2.disconnect()
     # can't unbind the texture...
+    timer.end()
 
 dx = dy = 0
 @window.event
@@ -148,6 +156,9 @@ fn = lambda dt:0
 pyglet.clock.schedule_interval(fn, 1/10)
 pyglet.app.run()
 pyglet.clock.unschedule(fn)
+print(timer.summary())
+timer.free()
+producer.close()
 
 TEX.free()
 TEX2.free()